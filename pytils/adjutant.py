@@ -1,5 +1,7 @@
 
+from concurrent.futures import ProcessPoolExecutor
 import logging
+import multiprocessing
 import numbers
 import traceback
 
@@ -83,6 +85,24 @@ def rindex(sequence, value):
     return None
 
 
+def fork_pool(workers, state):
+    # Forked processes inherit the (potentially unpicklable) state, rather than having it sent.  Tasks in the pool retrieve
+    # it via pool_state().
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+    return ProcessPoolExecutor(workers, context, initializer=_initialize_pool, initargs=(state,))
+
+
+_POOL = {}
+
+
+def _initialize_pool(state):
+    _POOL["state"] = state
+
+
+def pool_state():
+    return _POOL["state"]
+
+
 class Closing:
     def __init__(self, handle_fn, close_fn):
         self.handle_fn = check.check_function(handle_fn)
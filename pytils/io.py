@@ -5,6 +5,9 @@ import queue
 import sys
 
 
+GZIP_MAGIC = b"\x1f\x8b"
+
+
 def stdin_generator():
     for line in sys.stdin:
         yield line
@@ -15,13 +18,17 @@ def file_generator(input_file):
         if input_file.endswith("bz2"):
             return bz2.BZ2File(input_file)
         else:
-            try:
-                return open(input_file, "r", encoding="utf-8")
-            except UnicodeDecodeError as e:
+            with open(input_file, "rb") as fh:
+                magic = fh.read(len(GZIP_MAGIC))
+
+            if magic == GZIP_MAGIC:
                 return gzip.open(input_file, "rt", encoding="utf-8")
+            else:
+                return open(input_file, "r", encoding="utf-8")
 
     with opener() as fh:
-        for line in fh.readlines():
+        # Iterate the lines lazily, so that only a buffer's worth of the file is in memory at once.
+        for line in fh:
             if isinstance(line, bytes):
                 line = line.decode("utf-8")
 
@@ -1,43 +1,92 @@
 
+from array import array
+import bz2
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
+from itertools import islice
+import json
 import logging
+import lzma
+import mmap
 import os
 import pickle
 import queue
 import random
+import sys
 import threading
+import zlib
 
 from pytils import check
+from pytils.adjutant import fork_pool, pool_state
 
 
 EXTENSION = ".pickle"
 LENGTH_FILE = "length.txt"
+MANIFEST_FILE = "manifest.json"
+OFFSETS_EXTENSION = ".offsets"
+BUFFERS_EXTENSION = ".buffers"
+BUFFER_OFFSETS_EXTENSION = ".buffer-offsets"
+ITEM_BUFFERS_EXTENSION = ".item-buffers"
+FORMAT_VERSION = 1
 # 2147483648 - 1
 MAX_BYTES = (2**31) - 1
 # 100 MB = 100 * 1024 KB
 TARGET_FILE_SIZE = 100 * 1024 * 1024
 STREAM_TARGET_FILE_SIZE = 10 * 1024 * 1024
 STREAM_MAX_BATCH = 2000
+# The compression ratio is estimated from (up to) this many bytes of the pickled sample.
+COMPRESSION_SAMPLE = 1024 * 1024
+CODECS = {
+    "zlib": zlib,
+    "bz2": bz2,
+    "lzma": lzma,
+}
+# The options of directories saved before the manifest was introduced.
+LEGACY_MANIFEST = {
+    "offsets": False,
+    "codec": None,
+    "out_of_band": False,
+}
+# Out of band buffers smaller than this are kept in band, and those written out of band are aligned to this.
+OUT_OF_BAND_BYTES = 64 * 1024
+BUFFER_ALIGNMENT = 64
+
+
+def save(data, dir_path, converter=None, offsets=False, codec=None, workers=None, out_of_band=False):
+    """Save the data (a list, or a queue.Queue terminated by None) as a directory of pickled shards.
+
+    A manifest records the number of items in each shard.  With offsets, the items of each shard are pickled
+    individually, and their byte offsets are also recorded - so that get and load(start=..) can go straight to an item.
+    With a codec (one of CODECS), each shard is compressed - up to workers shards at a time, in threads.
+
+    With out_of_band, the items are pickled with protocol 5, and any large buffers they expose (ex: NumPy arrays, or
+    pickle.PickleBuffer wrapped bytes) are written uncompressed to an aligned side file.  These are loaded as views
+    over a memory map of the file, rather than being copied.
+    """
+    if codec is not None and codec not in CODECS:
+        raise ValueError("Unknown codec '%s' (expected one of: %s)." % (codec, ", ".join(sorted(CODECS.keys()))))
+
+    if workers is not None and workers <= 0:
+        raise ValueError("Workers must be positive.")
 
-
-def save(data, dir_path, converter=None):
     os.makedirs(dir_path, exist_ok=True)
+    writer = _ShardWriter(dir_path, offsets, codec, workers, out_of_band)
 
     if isinstance(data, queue.Queue):
-        thread = threading.Thread(target=_save_stream, args=[data, dir_path, converter])
+        thread = threading.Thread(target=_save_stream, args=[data, dir_path, converter, writer])
         # Non-daemon threads will keep the program running until they finish (as per documentation).
         thread.daemon = False
         thread.start()
     else:
-        _save(data, dir_path, converter)
+        _save(data, dir_path, converter, writer)
 
 
-def _save_stream(data, dir_path, converter):
+def _save_stream(data, dir_path, converter, writer):
     check.check_instance(data, queue.Queue)
     batch = []
     batch_size = None
-    i = 0
     try_size = 10
-    total_size = 0
 
     while True:
         item = data.get()
@@ -49,7 +98,7 @@ def _save_stream(data, dir_path, converter):
             if batch_size is None:
                 # Only try to discover the batch_size every so often.
                 if len(batch) % try_size == 0:
-                    average = _average_size(batch, converter)
+                    average = _average_size(batch, converter, writer.codec, writer.out_of_band)
                     sample_size = average * len(batch)
 
                     if sample_size > STREAM_TARGET_FILE_SIZE:
@@ -65,26 +114,19 @@ def _save_stream(data, dir_path, converter):
             else:
                 # The batch_size has been determined.
                 while len(batch) > batch_size:
-                    bytes_out = pickle.dumps(_convert(converter, batch[:batch_size]))
-                    _write_bytes(bytes_out, dir_path, i)
-                    i += 1
+                    writer.write(_convert(converter, batch[:batch_size]))
                     batch = batch[batch_size:]
-                    total_size += batch_size
         else:
             # The data stream is complete - flush the remaining data.
             if len(batch) > 0:
-                bytes_out = pickle.dumps(_convert(converter, batch))
-                _write_bytes(bytes_out, dir_path, i)
-                total_size += len(batch)
-
-            with open(os.path.join(dir_path, LENGTH_FILE), "w") as fh:
-                fh.write("%d" % total_size)
+                writer.write(_convert(converter, batch))
 
+            total_size = writer.close()
             logging.debug("Completed pickling stream for '%s' (%d items)." % (dir_path, total_size))
             break
 
 
-def _save(data, dir_path, converter):
+def _save(data, dir_path, converter, writer):
     check.check_list(data)
 
     if len(data) > 0:
@@ -95,32 +137,39 @@ def _save(data, dir_path, converter):
             sample_indices.add(random.randint(0, len(data) - 1))
 
         sample = [data[index] for index in sample_indices]
-        average = _average_size(sample, converter)
+        average = _average_size(sample, converter, writer.codec, writer.out_of_band)
         batch_size = max(1, int(TARGET_FILE_SIZE / average))
 
-        for i, offset in enumerate(range(0, len(data), batch_size)):
-            bytes_out = pickle.dumps(_convert(converter, data[offset:offset + batch_size]))
-            _write_bytes(bytes_out, dir_path, i)
+        for offset in range(0, len(data), batch_size):
+            writer.write(_convert(converter, data[offset:offset + batch_size]))
     else:
-        _write_bytes(pickle.dumps([]), dir_path, 0)
-
-    with open(os.path.join(dir_path, LENGTH_FILE), "w") as fh:
-        fh.write("%d" % len(data))
+        writer.write([])
 
+    writer.close()
     logging.debug("Completed pickling for '%s' (%d items)." % (dir_path, len(data)))
 
 
-def _average_size(sample, converter):
+def _average_size(sample, converter, codec, out_of_band):
+    # The average size of an item, as written to the shard (so compressed, if there is a codec) and its buffers.
     batch = [i for i in sample]
     average = None
 
     while average is None:
         try:
-            batch_size = len(pickle.dumps(_convert(converter, batch)))
-            average = batch_size / float(len(batch))
+            buffers = [] if out_of_band else None
+            bytes_out = _dumps(_convert(converter, batch), buffers)
+            average = len(bytes_out) / float(len(batch))
         except MemoryError as e:
             batch = batch[:int(len(batch) / 2.0)]
 
+    if codec is not None:
+        bytes_sample = bytes_out[:COMPRESSION_SAMPLE]
+        average *= len(CODECS[codec].compress(bytes_sample)) / float(len(bytes_sample))
+
+    if out_of_band:
+        # The out of band buffers are never compressed.
+        average += sum([memoryview(buffer).nbytes for buffer in buffers]) / float(len(batch))
+
     return average
 
 
@@ -128,8 +177,168 @@ def _convert(converter, batch):
     return batch if converter is None else [converter(b) for b in batch]
 
 
+class _ShardWriter(object):
+    # Writes the shards of a directory (and finally its manifest), with up to workers shards being written at once.
+    # The codecs release the GIL while compressing, so threads are enough to compress in parallel.
+    def __init__(self, dir_path, offsets, codec, workers, out_of_band):
+        super(_ShardWriter, self).__init__()
+        self.dir_path = dir_path
+        self.offsets = offsets
+        self.codec = codec
+        self.out_of_band = out_of_band
+        self.workers = 1 if workers is None else workers
+        self.counts = []
+        self.pending = deque()
+        self.executor = None if self.workers == 1 else ThreadPoolExecutor(self.workers)
+
+    def write(self, items):
+        index = len(self.counts)
+        self.counts += [len(items)]
+
+        if self.executor is None:
+            _write_shard(items, self.dir_path, index, self.offsets, self.codec, self.out_of_band)
+        else:
+            # Bound the shards held in memory, while any error raised in a thread is re-raised here.
+            while len(self.pending) >= self.workers:
+                self.pending.popleft().result()
+
+            self.pending.append(self.executor.submit(_write_shard, items, self.dir_path, index, self.offsets,
+                self.codec, self.out_of_band))
+
+    def close(self):
+        try:
+            while len(self.pending) > 0:
+                self.pending.popleft().result()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+        _write_manifest(self.dir_path, self.counts, self.offsets, self.codec, self.out_of_band)
+        return sum(self.counts)
+
+
+def _write_shard(items, dir_path, index, offsets, codec, out_of_band):
+    buffers = [] if out_of_band else None
+
+    if offsets:
+        # The items are pickled one after the other, with the offset of each (plus the end) in a side file.
+        positions = array("q", [0])
+        item_buffers = array("q", [0])
+        pickled = []
+
+        for item in items:
+            pickled += [_dumps(item, buffers)]
+            positions.append(positions[-1] + len(pickled[-1]))
+
+            if out_of_band:
+                item_buffers.append(len(buffers))
+
+        with open(_side_path(dir_path, index, OFFSETS_EXTENSION), "wb") as fh:
+            positions.tofile(fh)
+
+        if out_of_band:
+            # The index of the first out of band buffer of each item (plus the end).
+            with open(_side_path(dir_path, index, ITEM_BUFFERS_EXTENSION), "wb") as fh:
+                item_buffers.tofile(fh)
+
+        bytes_out = b"".join(pickled)
+    else:
+        bytes_out = _dumps(items, buffers)
+
+    if out_of_band:
+        _write_buffers(buffers, dir_path, index)
+
+    if codec is not None:
+        # The offsets are within the decompressed shard.
+        bytes_out = CODECS[codec].compress(bytes_out)
+
+    _write_bytes(bytes_out, dir_path, index)
+    return len(items)
+
+
+def _dumps(item, buffers):
+    if buffers is None:
+        return pickle.dumps(item)
+
+    return pickle.dumps(item, protocol=5, buffer_callback=lambda buffer: _out_of_band(buffer, buffers))
+
+
+def _out_of_band(buffer, buffers):
+    # Returning True keeps the buffer in band.
+    if memoryview(buffer).nbytes < OUT_OF_BAND_BYTES:
+        return True
+
+    buffers += [buffer]
+    return False
+
+
+def _write_buffers(buffers, dir_path, index):
+    # The buffers are written one after the other (each at an aligned position), with the (position, length) of each in
+    # a side file.
+    positions = array("q")
+    position = 0
+
+    with open(_side_path(dir_path, index, BUFFERS_EXTENSION), "wb") as fh:
+        for buffer in buffers:
+            with buffer.raw() as raw:
+                padding = -position % BUFFER_ALIGNMENT
+                fh.write(bytes(padding))
+                fh.write(raw)
+                positions.extend([position + padding, raw.nbytes])
+                position += padding + raw.nbytes
+
+    with open(_side_path(dir_path, index, BUFFER_OFFSETS_EXTENSION), "wb") as fh:
+        positions.tofile(fh)
+
+
+def _write_manifest(dir_path, counts, offsets, codec, out_of_band):
+    manifest = {
+        "version": FORMAT_VERSION,
+        "byteorder": sys.byteorder,
+        "counts": counts,
+        "offsets": offsets,
+        "codec": codec,
+        "out_of_band": out_of_band,
+    }
+
+    with open(os.path.join(dir_path, MANIFEST_FILE), "w") as fh:
+        json.dump(manifest, fh)
+
+    # Kept for the sake of length (and any older readers).
+    with open(os.path.join(dir_path, LENGTH_FILE), "w") as fh:
+        fh.write("%d" % sum(counts))
+
+
+def _read_manifest(dir_path):
+    # Directories saved before the manifest was introduced don't have one.
+    try:
+        with open(os.path.join(dir_path, MANIFEST_FILE), "r") as fh:
+            manifest = json.load(fh)
+    except FileNotFoundError:
+        return None
+
+    if manifest["version"] != FORMAT_VERSION:
+        raise ValueError("Cannot load pickler format version %s." % manifest["version"])
+
+    if manifest["codec"] is not None and manifest["codec"] not in CODECS:
+        raise ValueError("Cannot load shards compressed with unknown codec '%s'." % manifest["codec"])
+
+    if (manifest["offsets"] or manifest["out_of_band"]) and manifest["byteorder"] != sys.byteorder:
+        raise ValueError("Cannot load offsets saved with %s endian byte order." % manifest["byteorder"])
+
+    return manifest
+
+
+def _shard_path(dir_path, index):
+    return os.path.join(dir_path, str(index) + EXTENSION)
+
+
+def _side_path(dir_path, index, extension):
+    return os.path.join(dir_path, str(index) + extension)
+
+
 def _write_bytes(bytes_out, dir_path, index):
-    write_path = os.path.join(dir_path, str(index) + EXTENSION)
+    write_path = _shard_path(dir_path, index)
 
     # TODO
     #if os.path.exists(write_path):
@@ -152,7 +361,30 @@ def length(dir_path, allow_not_found=False):
             raise e
 
 
-def load(dir_path, allow_not_found=False, converter=None):
+def get(dir_path, index):
+    """Load the single item at the index (which may be negative, as for a list)."""
+    total = length(dir_path)
+    position = index + total if index < 0 else index
+
+    if position < 0 or position >= total:
+        raise IndexError("Index %d out of range for %d items." % (index, total))
+
+    for item in load(dir_path, start=position, stop=position + 1):
+        return item
+
+
+def load(dir_path, allow_not_found=False, converter=None, start=None, stop=None, workers=None, prefetch=None):
+    """Load the items, in order - or just those from start up to stop (as per a list slice, with step 1).
+
+    The converter is applied to each loaded item, with any None results being dropped.  With workers, the shards are
+    loaded in that many processes, up to prefetch shards (default: the number of workers) ahead of those consumed.
+    """
+    if workers is not None and workers <= 0:
+        raise ValueError("Workers must be positive.")
+
+    if prefetch is not None and prefetch <= 0:
+        raise ValueError("Prefetch must be positive.")
+
     try:
         sub_files = os.listdir(dir_path)
     except FileNotFoundError as e:
@@ -161,24 +393,240 @@ def load(dir_path, allow_not_found=False, converter=None):
         else:
             raise e
 
-    filtered_sub_files = filter(lambda item: item.endswith(EXTENSION), sub_files)
+    manifest = _read_manifest(dir_path)
+
+    if manifest is None:
+        filtered_sub_files = filter(lambda item: item.endswith(EXTENSION), sub_files)
+        shards = [(dir_path, index, None, None, LEGACY_MANIFEST) \
+            for index in sorted([int(item[:item.index(EXTENSION)]) for item in filtered_sub_files])]
+
+        if start is not None or stop is not None:
+            # Without the manifest, there's no telling which shards the slice falls in.  The length resolves any negative
+            # bounds, as per a list slice.
+            start, stop, step = slice(start, stop).indices(length(dir_path))
+            items = islice((item for shard in shards for item in _read(shard)), start, stop)
+            yield from _convert_items(converter, items)
+            return
+    else:
+        shards = _slice_shards(dir_path, manifest, start, stop)
+
+    compressed = manifest is not None and manifest["codec"] is not None
+
+    if workers is None or workers == 1 or (converter is None and not compressed):
+        for shard in shards:
+            yield from _convert_items(converter, _read(shard))
+    else:
+        yield from _load_parallel(shards, converter, workers, workers if prefetch is None else prefetch)
+
+
+def _slice_shards(dir_path, manifest, start, stop):
+    # Produces the (dir path, index, lower, upper, manifest) of each shard overlapping [start, stop).
+    start, stop, step = slice(start, stop).indices(sum(manifest["counts"]))
+    shards = []
+    shard_start = 0
+
+    for index, count in enumerate(manifest["counts"]):
+        shard_stop = shard_start + count
+
+        if shard_start < stop and start < shard_stop:
+            shards += [(dir_path, index, max(start, shard_start) - shard_start, min(stop, shard_stop) - shard_start,
+                manifest)]
+
+        shard_start = shard_stop
+
+    return shards
+
+
+def _load_parallel(shards, converter, workers, prefetch):
+    # Only the work which saves this process time runs in the workers.  With a converter, they decompress, decode and
+    # convert the shards, sending back just the results.  Otherwise, they only decompress the shards, and the items are
+    # decoded here from those bytes - decoding them in the workers would only have the items pickled back, to be
+    # decoded here all over again.  For the same reason, load doesn't use workers for plain (uncompressed) shards
+    # without a converter.
+    task = _decompress_shard if converter is None else _decode_shard
+    pending = deque()
+    remaining = iter(shards)
+
+    with fork_pool(workers, converter) as executor:
+        try:
+            for shard in islice(remaining, prefetch):
+                pending.append((shard, executor.submit(task, shard)))
+
+            while len(pending) > 0:
+                shard, future = pending.popleft()
+                # Any error raised in a worker is re-raised here.
+                result = future.result()
+
+                for next_shard in islice(remaining, 1):
+                    pending.append((next_shard, executor.submit(task, next_shard)))
+
+                yield from result if converter is not None else _read(shard, result)
+        finally:
+            for shard, future in pending:
+                future.cancel()
+
+
+def _decode_shard(shard):
+    # Views over this worker's memory map can't be sent back, so the out of band buffers are decoded from copies.
+    return list(_convert_items(pool_state(), _read(shard, copy_buffers=True)))
+
+
+def _decompress_shard(shard):
+    # Produces the decompressed bytes of the shard - with offsets, just those of the items [lower, upper).
+    dir_path, index, lower, upper, manifest = shard
+
+    with _open_shard(_shard_path(dir_path, index), manifest["codec"]) as fh:
+        if not manifest["offsets"]:
+            return fh.read()
+
+        positions = _read_array(_side_path(dir_path, index, OFFSETS_EXTENSION), lower, upper + 1)
+        fh.seek(positions[0])
+        return fh.read(positions[-1] - positions[0])
+
+
+def _convert_items(converter, items):
+    if converter is None:
+        return items
+
+    return (result for result in map(converter, items) if result is not None)
+
+
+def _read(shard, decompressed=None, copy_buffers=False):
+    # The decompressed bytes (from _decompress_shard), when given, stand in for the shard file.
+    dir_path, index, lower, upper, manifest = shard
+
+    if manifest["offsets"]:
+        return _read_items(dir_path, index, lower, upper, manifest, decompressed, copy_buffers)
+
+    if manifest["out_of_band"]:
+        buffers = _read_buffers(dir_path, index, 0, None, copy_buffers)
+    else:
+        buffers = None
+
+    with _open(dir_path, index, manifest, decompressed) as fh:
+        # Unpickle straight from the (buffered) file, rather than from a copy of all of its bytes.
+        items = pickle.load(fh, buffers=buffers)
+
+    return items if lower is None else islice(items, lower, upper)
+
+
+class _ZlibReader(io.RawIOBase):
+    # Decompresses a zlib compressed file as it is read (there is no zlib file object), much like bz2.open or lzma.open.
+    def __init__(self, path):
+        super(_ZlibReader, self).__init__()
+        self.fh = open(path, "rb")
+        self._restart()
+
+    def _restart(self):
+        self.fh.seek(0)
+        self.decompressor = zlib.decompressobj()
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if len(self.decompressor.unconsumed_tail) > 0:
+                compressed = self.decompressor.unconsumed_tail
+            elif self.decompressor.eof:
+                return 0
+            else:
+                compressed = self.fh.read(io.DEFAULT_BUFFER_SIZE)
+
+            decompressed = self.decompressor.decompress(compressed, len(buffer))
+
+            if len(decompressed) > 0:
+                buffer[:len(decompressed)] = decompressed
+                self.position += len(decompressed)
+                return len(decompressed)
+            elif len(compressed) == 0:
+                return 0
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Can only seek from the start or current position.")
+
+        # Seeking backwards starts over; either way, the data up to the offset is decompressed and discarded.
+        if offset < self.position:
+            self._restart()
+
+        scratch = bytearray(io.DEFAULT_BUFFER_SIZE)
+
+        while self.position < offset:
+            if self.readinto(memoryview(scratch)[:offset - self.position]) == 0:
+                break
+
+        return self.position
+
+    def close(self):
+        self.fh.close()
+        super(_ZlibReader, self).close()
+
+
+def _open(dir_path, index, manifest, decompressed):
+    if decompressed is None:
+        return _open_shard(_shard_path(dir_path, index), manifest["codec"])
+
+    return io.BytesIO(decompressed)
+
+
+def _open_shard(shard_path, codec):
+    if codec is None:
+        return open(shard_path, "rb")
+    elif codec == "zlib":
+        return io.BufferedReader(_ZlibReader(shard_path))
+
+    # The bz2 and lzma file objects decompress as they are read (and seek by decompressing up to the position).
+    return CODECS[codec].open(shard_path, "rb")
+
+
+def _read_items(dir_path, index, lower, upper, manifest, decompressed=None, copy_buffers=False):
+    if manifest["out_of_band"]:
+        item_buffers = _read_array(_side_path(dir_path, index, ITEM_BUFFERS_EXTENSION), lower, upper + 1)
+        buffers = _read_buffers(dir_path, index, item_buffers[0], item_buffers[-1], copy_buffers)
+    else:
+        buffers = None
+
+    with _open(dir_path, index, manifest, decompressed) as fh:
+        if decompressed is None:
+            fh.seek(_read_array(_side_path(dir_path, index, OFFSETS_EXTENSION), lower, lower + 1)[0])
+
+        for i in range(lower, upper):
+            # Successive loads consume the buffers in order.  A single unpickler's memo would keep every item loaded so
+            # far alive (and clearing it after each item is costly).
+            yield pickle.load(fh, buffers=buffers)
+
+
+def _read_array(path, start, stop=None):
+    values = array("q")
+
+    with open(path, "rb") as fh:
+        fh.seek(start * values.itemsize)
+        values.frombytes(fh.read() if stop is None else fh.read((stop - start) * values.itemsize))
 
-    for sub_file in sorted(filtered_sub_files, key=lambda item: int(item[:item.index(EXTENSION)])):
-        file_path = os.path.join(dir_path, sub_file)
-        size = os.path.getsize(file_path)
+    return values
 
-        with open(file_path, "rb") as fh:
-            bytes_in = bytearray(0)
 
-            for i in range(0, size, MAX_BYTES):
-                bytes_in += fh.read(MAX_BYTES)
+def _read_buffers(dir_path, index, first, last, copy=False):
+    # Produces views over a memory map of the out of band buffers [first, last), which keep the map open while in use
+    # (or otherwise, copies of them).
+    positions = _read_array(_side_path(dir_path, index, BUFFER_OFFSETS_EXTENSION), 2 * first,
+        None if last is None else 2 * last)
 
-            for item in pickle.loads(bytes_in):
-                if converter is None:
-                    yield item
-                else:
-                    result = converter(item)
+    if len(positions) == 0:
+        return iter([])
 
-                    if result is not None:
-                        yield result
+    with open(_side_path(dir_path, index, BUFFERS_EXTENSION), "rb") as fh:
+        view = memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
 
+    views = [view[positions[i]:positions[i] + positions[i + 1]] for i in range(0, len(positions), 2)]
+    return iter([bytes(view) for view in views] if copy else views)
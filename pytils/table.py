@@ -1,29 +1,74 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import Counter
 from csv import reader as csv_reader
+from datetime import date
+import heapq
+from itertools import chain, islice
+import json
+import math
+import mmap
+import operator
+import os
+import pickle
 import random
+import sys
+import tempfile
+
+from pytils import pickler
+from pytils.adjutant import fork_pool, pool_state, str_as_bool
+from pytils.io import file_generator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 INDEXING = "indexing"
+INNER = "inner"
+LEFT = "left"
+RIGHT = "right"
+OUTER = "outer"
+HASH = "hash"
+SORTED = "sorted"
+CHUNK_ROWS = 100000
+CHUNKS_PER_WORKER = 4
+INFER_SAMPLE = 1000
+SELECTIVITY_SAMPLE = 100
+DESCRIBE_SAMPLE = 1024
+NUMERIC_TYPECODES = "bBhHiIlLqQfd"
+QUARTILES = [0.25, 0.5, 0.75]
+DESCRIBE_HEADER = ["name", "count", "nulls", "distinct", "min", "max", "mean", "stddev", "q1", "q2", "q3"]
+FORMAT_VERSION = 1
+LAYOUT_FILE = "table.json"
+STRING_KIND = "str"
+PICKLE_KIND = "pickle"
+CATEGORY_KIND = "category"
+SUM = "sum"
+COUNT = "count"
+MEAN = "mean"
+MIN = "min"
+MAX = "max"
+FIRST = "first"
+LAST = "last"
 
 
 class Table(object):
     def __init__(self, header=[], rows=[]):
         super(Table, self).__init__()
-        self._header = header
-        self._rows = rows
-        self._columns = [[] for i in range(0, self.width())]
-
-        for row in self._rows:
-            if self.width() != len(row):
-                raise ValueError("All rows must have exactly %d items.  " \
-                    "Found one with %d items." % (self.width(), len(row)))
-
-            for i in range(0, self.width()):
-                self._columns[i] += [row[i]]
-
+        self._set(header, _columns_of(len(header), rows, _as_column))
+
+    def _set(self, header, columns):
+        # Each column is stored exactly once, as a typed array.array for homogeneous int/float data, or otherwise a list.
+        # Columns are never mutated, so they may be freely shared between tables.
+        self._header = [h for h in header]
+        self._columns = columns
+        self._indexes = {}
+        self._descriptions = {}
         header_set = set(self._header)
 
         if len(header_set) < len(self._header):
@@ -35,131 +80,142 @@ class Table(object):
             raise ValueError("Each header must be uniquely named.  " \
                 "Found duplicates: [%s]." % ",".join(duplicates))
 
-    def refine(self, name=None, func_match=None, refinements=None):
+    @staticmethod
+    def _from_columns(header, columns):
+        table = Table.__new__(Table)
+        table._set(header, columns)
+        return table
+
+    def refine(self, name=None, func_match=None, refinements=None, selectivity=None):
         """Produce a table, including only the rows matching some criteria.
-        """
-        if refinements is not None:
-            if name is not None or func_match is not None:
-                raise ValueError("May only define (name, func_match) or " \
-                    "refinements, but not both.")
 
-            if not isinstance(refinements, dict):
-                raise TypeError("refinements must be a dict.")
-        elif name is None or func_match is None:
-            raise ValueError("Must define either (name, func_match) or " \
-                "refinements.")
+        The refinements are compiled into a sequence of tests, each only run on the rows which pass the tests before
+        it: equality tests first, then the functions from most to least selective.  The selectivity of each function
+        (the fraction of rows it is expected to pass) is measured on a sample of the rows, unless hinted by name.
+        """
+        equalities = []
+        functions = []
+        candidates = None
+        candidate_name = None
+        mask = None
+
+        for name, func_match in _refinements(name, func_match, refinements).items():
+            column = self._columns[self._find(name)]
+
+            if _vectorizable(func_match):
+                matched = numpy.asarray(func_match(_as_ndarray(column)), dtype=bool)
+                mask = matched if mask is None else mask & matched
+                continue
+
+            if callable(func_match):
+                functions += [(name, _function_test(column, func_match))]
+                continue
+
+            equalities += [(name, _equality_test(column, func_match))]
+
+            # Narrow down the rows to check using the most selective index (or categorical column) available.
+            if name in self._indexes:
+                index = self._indexes[name].get(HASH, self._indexes[name].get(SORTED))
+
+                try:
+                    indexed = index.lookup(func_match)
+                except TypeError:
+                    # The value isn't hashable (or comparable with the indexed values), so just check every row.
+                    indexed = None
+            elif isinstance(column, _Categorical):
+                indexed = column.positions(func_match)
+            else:
+                indexed = None
 
-        refinement = [lambda v: True for i in range(0, self.width())]
+            if indexed is not None and (candidates is None or len(indexed) < len(candidates)):
+                candidates = indexed
+                candidate_name = name
 
-        if refinements is None:
-            col = self._find(name)
-            refinement[col] = func_match
-        else:
-            for name, func_match in refinements.items():
-                col = self._find(name)
-                refinement[col] = func_match
+        if mask is not None:
+            if candidates is None:
+                candidates = numpy.flatnonzero(mask).tolist()
+            else:
+                candidates = [position for position in candidates if mask[position]]
 
-        rows = []
+        positions = range(0, self.height()) if candidates is None else sorted(candidates)
 
-        for data in self.rows():
-            all_match = True
+        if len(functions) > 1:
+            functions = _order_tests(functions, positions, selectivity)
 
-            for i in range(0, self.width()):
-                if callable(refinement[i]):
-                    all_match &= refinement[i](data[i])
-                else:
-                    all_match &= refinement[i] == data[i]
+        # The candidates already satisfy their own equality, so it needn't be tested again.
+        tests = [test for name, test in equalities if name != candidate_name] + [test for name, test in functions]
 
-            if all_match:
-                rows += [data]
+        for test in tests:
+            positions = filter(test, positions)
 
-        return Table(self.header(), rows)
+        return self._take(list(positions))
 
-    def convert(self, name=None, func=None, conversions=None):
+    def convert(self, name=None, func=None, conversions=None, workers=None):
         """Produce a table with values based on some transformations.
-        """
-        if conversions is not None:
-            if name is not None or func is not None:
-                raise ValueError("May only define (name, func) or " \
-                    "conversions, but not both.")
-
-            if not isinstance(conversions, dict):
-                raise TypeError("Conversions must be a dict.")
-        elif name is None or func is None:
-            raise ValueError("Must define either (name, func) or " \
-                "conversions.")
 
-        transformations = [lambda v: v for i in range(0, self.width())]
+        With workers, the (non-vectorized) transformations are applied to chunks of the rows in that many processes.
+        """
+        transformations = [None for i in range(0, self.width())]
 
-        if conversions is None:
+        for name, func in _conversions(name, func, conversions).items():
             col = self._find(name)
             transformations[col] = func
-        else:
-            for name, func in conversions.items():
-                col = self._find(name)
-                transformations[col] = func
 
-        rows = []
-
-        for data in self.rows():
-            row = []
-
-            for i in range(0, len(transformations)):
-                row += [transformations[i](data[i])]
-
-            rows += [row]
+        plain = [i for i in range(0, self.width()) if transformations[i] is not None and not _vectorizable(transformations[i])]
+        converted = _apply(workers, self.height(), _convert_chunk,
+            [self._columns[i] for i in plain], [transformations[i] for i in plain])
+        columns = []
+
+        for i, column in enumerate(self._columns):
+            if transformations[i] is None:
+                # Untouched columns are shared with this table rather than copied.
+                columns += [column]
+            elif _vectorizable(transformations[i]):
+                columns += [_from_ndarray(transformations[i](_as_ndarray(column)), len(column))]
+            else:
+                columns += [_as_column(converted[plain.index(i)])]
 
-        return Table(self.header(), rows)
+        return Table._from_columns(self.header(), columns)
 
-    def extend(self, names=None, func=None, target=None, extensions=None):
+    def extend(self, names=None, func=None, target=None, extensions=None, workers=None):
         """Produce a table with new columns based on some transformations.
-        """
-        if extensions is not None:
-            if names is not None or func is not None and target is not None:
-                raise ValueError("May only define (names, func, target) or " \
-                    "extensions, but not both.")
-
-            if not isinstance(extensions, list):
-                raise TypeError("Extensions must be a list.")
-        elif names is None or func is None or target is None:
-            raise ValueError("Must define either (names, func, target) or " \
-                "extensions.")
 
+        With workers, the (non-vectorized) transformations are applied to chunks of the rows in that many processes.
+        """
         transformations = []
 
-        if extensions is None:
+        for ext in _extensions(names, func, target, extensions):
             transformations += [{
-                "cols": [self._find(name) for name in names],
-                "func": func,
-                "target": target
+                "cols": [self._find(name) for name in ext["names"]],
+                "func": ext["func"],
+                "target": ext["target"]
             }]
-        else:
-            for ext in extensions:
-                transformations += [{
-                    "cols": [self._find(name) for name in ext["names"]],
-                    "func": ext["func"],
-                    "target": ext["target"]
-                }]
 
         extended_headers = [trans["target"] for trans in transformations]
-        rows = []
-
-        for data in self.rows():
-            row = [d for d in data]
-
-            for trans in transformations:
-                sources = [data[col] for col in trans["cols"]]
-                row += [trans["func"](*sources)]
-
-            rows += [row]
+        plain = [trans for trans in transformations if not _vectorizable(trans["func"])]
+        extended = _apply(workers, self.height(), _extend_chunk,
+            [[self._columns[col] for col in trans["cols"]] for trans in plain], [trans["func"] for trans in plain])
+        columns = [column for column in self._columns]
+
+        for trans in transformations:
+            if _vectorizable(trans["func"]):
+                sources = [_as_ndarray(self._columns[col]) for col in trans["cols"]]
+                columns += [_from_ndarray(trans["func"](*sources), self.height())]
+            else:
+                columns += [_as_column(extended[plain.index(trans)])]
 
-        return Table(self.header() + extended_headers, rows)
+        return Table._from_columns(self.header() + extended_headers, columns)
 
     def narrow(self, names, unique=False):
         """Produce a table, including only a the columns specified.
         """
-        data = self.rows(names, unique=unique)
-        return Table(names, data)
+        if unique:
+            columns = [self._columns[self._find(name)] for name in names]
+            positions = [position for position, data in _distinct(self._iter_rows(names))]
+            return Table._from_columns(names, [_gather(column, positions) for column in columns])
+
+        # The columns are shared with this table, rather than copied.
+        return Table._from_columns(names, [self._columns[self._find(name)] for name in names])
 
     def drop(self, names, unique=False):
         """Produce a table including all columns except those specified.
@@ -171,24 +227,50 @@ class Table(object):
 
         return self.narrow(columns, unique)
 
-    def join(self, name, other_table, other_name):
-        """Produce a table which is the 'inner join' of this and another table.
+    def join(self, name, other_table, other_name, how=INNER, suffixes=("_0", "_1")):
+        """Produce a table which is the join of this and another table.
+
+        The join is an 'inner join', unless how is LEFT, RIGHT or OUTER, in which case unmatched rows are padded out
+        with None.  Join on a multi-column key by passing lists for both name and other_name.  Header names that
+        appear in both tables are renamed using the suffixes (for this table and the other table, respectively).
+
+        The rows are in the order of this table's rows, and then the other table's rows for each of them.  Any
+        unmatched rows of the other table (for RIGHT or OUTER) come last, in their order.
         """
-        values = Counter(self.column(name)).keys()
-        other_values = Counter(other_table.column(other_name)).keys()
+        if how not in [INNER, LEFT, RIGHT, OUTER]:
+            raise ValueError("Unknown join '%s'." % how)
 
-        rows = []
+        names = name if isinstance(name, list) else [name]
+        other_names = other_name if isinstance(other_name, list) else [other_name]
+
+        if len(names) != len(other_names):
+            raise ValueError("Must join on the same number of columns from each table.  " \
+                "Found %d and %d." % (len(names), len(other_names)))
 
-        for value in values:
-            if value in other_values:
-                value_table = self.refine(name, value)
-                other_value_table = other_table.refine(other_name, value)
+        keys = self._keys(names)
+        other_keys = other_table._keys(other_names)
 
-                for data in value_table.rows():
-                    for other_data in other_value_table.rows():
-                        rows += [data + other_data]
+        if isinstance(keys, _Categorical) and isinstance(other_keys, _Categorical):
+            # Join on the codes, once the other table's codes are translated into this table's dictionary.
+            other_keys = other_keys.recode(keys)
+            keys = keys.codes
 
-        return Table(self.header() + other_table.header(), rows)
+        # Build the hash table over the smaller side, and probe it with the larger side.
+        if len(keys) <= len(other_keys):
+            positions, other_positions = _hash_join(keys, other_keys, how in [LEFT, OUTER], how in [RIGHT, OUTER])
+            # The pairs come out in the other table's order.
+            positions, other_positions = _order_pairs(positions, other_positions, len(keys))
+        else:
+            other_positions, positions = _hash_join(other_keys, keys, how in [RIGHT, OUTER], how in [LEFT, OUTER])
+
+        header = self.header()
+        other_header = other_table.header()
+        collisions = set(header) & set(other_header)
+        header = [h + suffixes[0] if h in collisions else h for h in header]
+        other_header = [h + suffixes[1] if h in collisions else h for h in other_header]
+        columns = [_gather(column, positions, how != INNER) for column in self._columns] \
+            + [_gather(column, other_positions, how != INNER) for column in other_table._columns]
+        return Table._from_columns(header + other_header, columns)
 
     def merge(self, other_table):
         """Produce a table which is the combination of this and another table.
@@ -196,90 +278,235 @@ class Table(object):
         if self.header() != other_table.header():
             raise ValueError("For tables to merge they must have the same header.")
 
-        rows = self.rows()
-        rows += other_table.rows()
-        return Table(self.header(), rows)
+        columns = [_chain([column, other_column]) for column, other_column in zip(self._columns, other_table._columns)]
+        return Table._from_columns(self.header(), columns)
 
     def top(self, n):
-        rows = []
+        n = min(max(0, n), self.height())
+        return Table._from_columns(self.header(), [_slice(column, 0, n) for column in self._columns])
+
+    def bottom(self, n):
+        start = max(0, self.height() - max(0, n))
+        return Table._from_columns(self.header(), [_slice(column, start, len(column)) for column in self._columns])
+
+    def materialize(self):
+        """Produce a table with its own compact copy of the data.
+
+        Tables produced by narrow, drop, top, bottom and merge are views which share (and so keep alive) the columns of
+        the tables they came from.
+        """
+        return Table._from_columns(self.header(), [_compact(column) for column in self._columns])
+
+    def top_by(self, name, n, reverse=False):
+        """Produce a table of the n rows with the smallest (or when reverse, the largest) values in the named column.
+
+        Equivalent to sort(name, reverse).top(n), but without sorting the entire table.
+        """
+        column = self._columns[self._find(name)]
 
         if n <= 0:
-            return Table(self.header(), rows)
+            return self.top(0)
+
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        return self._take(select(n, range(0, self.height()), key=_sort_key(column)))
 
-        i = 0
+    def sort(self, name, reverse=False):
+        """Produce a table sorted by the named column, or list of columns (the first being the most significant).
+
+        The reverse may be a single boolean, or a list of booleans - one per name.
+        """
+        names, reverse = _sort_orders(name, reverse)
+        positions = list(range(0, self.height()))
 
-        for data in self.rows():
-            rows += [data]
-            i += 1
+        # Stable sorts from the least to the most significant column build up the composite order.
+        for name, descending in reversed(list(zip(names, reverse))):
+            positions.sort(key=_sort_key(self._columns[self._find(name)]), reverse=descending)
 
-            if i >= n:
-                break
+        return self._take(positions)
 
-        return Table(self.header(), rows)
+    def categorize(self, names):
+        """Produce a table with the named columns dictionary encoded.
 
-    def bottom(self, n):
+        Each distinct value is stored once, and the rows refer to it by an integer code.  This saves a lot of memory
+        for low cardinality columns, and lets refine, join, sort and group_by work directly on the codes.  Columns mixing
+        value types (other than None) cannot be categorized.
+        """
+        columns = [column for column in self._columns]
+
+        for name in names:
+            col = self._find(name)
+            columns[col] = _categorize(columns[col])
+
+        return Table._from_columns(self.header(), columns)
+
+    def shuffle(self):
+        positions = list(range(0, self.height()))
+        random.shuffle(positions)
+        return self._take(positions)
+
+    def sample(self, n, seed=None, replace=False):
+        """Produce a table of n randomly sampled rows (with or without replacement), in the order they were drawn.
+
+        Only the sampled rows are copied, so this is cheap for a small sample of a large table.
+        """
+        sampler = random.Random(seed)
+
+        if replace:
+            if n > 0 and self.height() == 0:
+                raise ValueError("Cannot sample from an empty table.")
+
+            positions = sampler.choices(range(0, self.height()), k=n)
+        else:
+            if n > self.height():
+                raise ValueError("Cannot sample %d rows from %d without replacement." % (n, self.height()))
+
+            positions = sampler.sample(range(0, self.height()), n)
+
+        return self._take(positions)
+
+    def stratified_sample(self, name, n_per_group, seed=None):
+        """Produce a table of (up to) n_per_group randomly sampled rows for each value of the named column.
+
+        Each value's sample is kept in a reservoir during a single pass over the column.  The sampled rows keep their
+        relative order from this table.
+        """
+        sampler = random.Random(seed)
+        column = self._columns[self._find(name)]
+        keys = column.codes if isinstance(column, _Categorical) else column
+        reservoirs = {}
+        counts = Counter()
+
+        for position, key in enumerate(keys):
+            counts[key] += 1
+            count = counts[key]
+
+            if count <= n_per_group:
+                if count == 1:
+                    reservoirs[key] = [position]
+                else:
+                    reservoirs[key] += [position]
+            else:
+                i = sampler.randrange(count)
+
+                if i < n_per_group:
+                    reservoirs[key][i] = position
+
+        return self._take(sorted(chain.from_iterable(reservoirs.values())))
+
+    def between(self, name, lower=None, upper=None):
+        """Produce a table, including only the rows where the named column is within [lower, upper].
+
+        Either bound may be None to leave that side unbounded.  Uses the SORTED index for the column, if one exists.
+        """
+        col = self._find(name)
+
+        if SORTED in self._indexes.get(name, {}):
+            positions = sorted(self._indexes[name][SORTED].range(lower, upper))
+        else:
+            positions = [position for position, value in enumerate(self._columns[col]) \
+                if (lower is None or lower <= value) and (upper is None or value <= upper)]
+
+        return self._take(positions)
+
+    def describe(self, names=None):
+        """Produce a table of summary statistics, with one row per column (or just the named columns).
+
+        Each column is described by the count of non-null values, the count of nulls (None), the count of distinct
+        values, the min and max, the mean and (population) standard deviation of numeric columns, and approximate
+        quartiles from a sample of the values.  Statistics which don't apply to a column are None.  Typed (int or float)
+        columns are described with a few passes of the builtin reductions, and any other column with a single pass.
+        Tables never change, so the descriptions are cached.
+        """
+        names = self.header() if names is None else names
         rows = []
-        i = 0
-        c = self.height() - n
 
-        for data in self.rows():
-            if i >= c:
-                rows += [data]
+        for name in names:
+            if name not in self._descriptions:
+                self._descriptions[name] = _describe(self._columns[self._find(name)])
 
-            i += 1
+            rows += [[name] + self._descriptions[name]]
 
-        return Table(self.header(), rows)
+        return Table(DESCRIBE_HEADER, rows)
+
+    def group_by(self, names):
+        """Group the rows of this table by the values of the named columns, for use with Grouping.aggregate.
+        """
+        return Grouping(self, names)
+
+    def create_index(self, name, kind=HASH):
+        """Index the named column, so that refine (for HASH or SORTED) and between (for SORTED) can look up rows directly.
+
+        Returns this table, for convenience.
+        """
+        if kind not in [HASH, SORTED]:
+            raise ValueError("Unknown index '%s'." % kind)
 
-    def sort(self, name, reverse=False):
         col = self._find(name)
-        rows = sorted(self.rows(), key=lambda row: row[col], reverse=reverse)
-        return Table(self.header(), rows)
+        self._indexes.setdefault(name, {})[kind] = _Index(self._columns[col], kind)
+        return self
 
-    def shuffle(self):
-        rows = self.rows()
-        random.shuffle(rows)
-        return Table(self.header(), rows)
+    def lazy(self):
+        """Produce a lazy plan of operations over this table, which are only run on collect().
+        """
+        return LazyTable(self, [], self.header())
 
     def column(self, name, limit=None):
         if limit is not None and limit < 0:
             raise ValueError("Limit must be 0 or positive.")
 
         col = self._find(name)
-        return self._columns[col][:limit]
+        return _as_list(self._columns[col], limit)
 
     def width(self):
-        return len(self.header())
+        return len(self._header)
 
     def height(self):
-        return len(self.rows())
+        return len(self._columns[0]) if len(self._columns) > 0 else 0
 
     def header(self):
         return [h for h in self._header]
 
     def rows(self, names=None, limit=None, unique=False):
+        if limit is not None and limit < 0:
+            raise ValueError("Limit must be 0 or positive.")
+
         headers = self.header()
 
         if names is not None:
             headers = names
 
-        columns = [self.column(name, limit) for name in headers]
-        as_rows = []
+        if unique:
+            return [list(data) for position, data in _distinct(self._iter_rows(headers, limit))]
 
-        if len(columns) > 0:
-            row_index = 0
+        return [list(data) for data in self._iter_rows(headers, limit)]
+
+    def distinct(self, names):
+        """Count each distinct combination of values from the named columns, in the order they are first seen.
+
+        Produces a Counter keyed by the value tuples, so the number of distinct values is simply its length.
+        """
+        return Counter(self._iter_rows(names))
+
+    def _iter_rows(self, names=None, limit=None):
+        # Row tuples are only built here, on demand, from the column storage.
+        if names is None:
+            columns = self._columns
+        else:
+            columns = [self._columns[self._find(name)] for name in names]
 
-            while row_index < len(columns[0]):
-                as_row = []
+        if len(columns) == 0:
+            return iter([])
 
-                for column in columns:
-                    as_row += [column[row_index]]
+        return islice(zip(*columns), limit)
 
-                if as_row not in as_rows or not unique:
-                    as_rows += [as_row]
+    def _keys(self, names):
+        if len(names) == 1:
+            return self._columns[self._find(names[0])]
 
-                row_index += 1
+        return list(zip(*[self._columns[self._find(name)] for name in names]))
 
-        return as_rows
+    def _take(self, positions):
+        return Table._from_columns(self.header(), [_gather(column, positions) for column in self._columns])
 
     def draw(self, names=None):
         if names is None:
@@ -308,8 +535,28 @@ class Table(object):
 
         return i
 
+    def __getstate__(self):
+        # Memory mapped columns (from open) and views cannot be pickled, so are pickled as their compact copies.
+        state = dict(self.__dict__)
+        state["_columns"] = [_compact(column) for column in self._columns]
+        state["_indexes"] = {}
+        return state
+
+    def __setstate__(self, state):
+        if "_indexes" not in state:
+            # Tables pickled by earlier versions hold their rows alongside plain list columns.
+            state = dict(state)
+            state.pop("_rows", None)
+            state["_columns"] = [_as_column(column) for column in state["_columns"]]
+
+        self.__dict__.update(state)
+        self._indexes = {}
+        self._descriptions = state.get("_descriptions", {})
+
     def __eq__(self, other):
-        return self.header() == other.header() and self.rows() == other.rows()
+        return self.header() == other.header() \
+            and self.height() == other.height() \
+            and all([_column_equals(a, b) for a, b in zip(self._columns, other._columns)])
 
     def __repr__(self):
         return "Table: (width=%d, height=%d)" % (self.width(), self.height())
@@ -321,12 +568,136 @@ class Table(object):
         return str(self)
 
     @staticmethod
-    def load_csv(csv, conversions=None, rename_strategy=None):
+    def load_csv(csv, conversions=None, rename_strategy=None, infer_types=False):
+        """Load a table from the csv (a string or lines).
+
+        With infer_types, each column is parsed directly into int, float, bool (as per adjutant.str_as_bool) or date
+        values, using the first of these which a sample of its values fits - empty values become None.  Any conversions
+        are applied after the inference.
+        """
         if isinstance(csv, str):
             reader = csv_reader(csv.split("\n"))
         else:
             reader = csv_reader(csv)
 
+        # All the rows make up a single chunk.
+        return next(Table._read_csv(reader, None, conversions, rename_strategy, infer_types))
+
+    def save(self, path):
+        """Save this table to the directory path, as one binary file per column.
+
+        Int and float columns are written as fixed width arrays, string columns as their utf-8 encoded values plus the
+        offsets between them, and any other column is pickled.
+        """
+        os.makedirs(path, exist_ok=True)
+        kinds = [_save_column(column, path, i) for i, column in enumerate(self._columns)]
+        layout = {
+            "version": FORMAT_VERSION,
+            "byteorder": sys.byteorder,
+            "height": self.height(),
+            "header": self.header(),
+            "kinds": kinds,
+        }
+
+        with open(os.path.join(path, LAYOUT_FILE), "w") as fh:
+            json.dump(layout, fh)
+
+    @staticmethod
+    def open(path, mmap=True):
+        """Open a table saved to the directory path.
+
+        Unless mmap is False, the column files are memory mapped, so their data is only read in as it is used.
+        """
+        with open(os.path.join(path, LAYOUT_FILE), "r") as fh:
+            layout = json.load(fh)
+
+        if layout["version"] != FORMAT_VERSION:
+            raise ValueError("Cannot open table format version %s." % layout["version"])
+
+        if layout["byteorder"] != sys.byteorder:
+            raise ValueError("Cannot open a table saved with %s endian byte order." % layout["byteorder"])
+
+        columns = [_open_column(path, i, kind, layout["height"], mmap) for i, kind in enumerate(layout["kinds"])]
+        return Table._from_columns(layout["header"], columns)
+
+    @staticmethod
+    def iter_csv(csv, chunk_rows=CHUNK_ROWS, conversions=None, rename_strategy=None, infer_types=False):
+        """Produce the tables of (up to) chunk_rows rows each, for a csv file path or file handle.
+
+        All the chunks share the header parsed from the first line.  Paths are read via pytils.io.file_generator, so
+        may be gzip or bz2 compressed.  The conversions and infer_types are as per load_csv, with the types inferred
+        for each chunk separately.
+        """
+        if chunk_rows <= 0:
+            raise ValueError("Chunk rows must be positive.")
+
+        if isinstance(csv, str):
+            reader = csv_reader(file_generator(csv))
+        else:
+            reader = csv_reader(csv)
+
+        return Table._read_csv(reader, chunk_rows, conversions, rename_strategy, infer_types)
+
+    @staticmethod
+    def iter_sorted(tables, name, reverse=False, spill_dir=None, chunk_rows=CHUNK_ROWS):
+        """Produce the tables of (up to) chunk_rows rows each, for the rows of all the tables sorted as per sort.
+
+        For sorting more rows than fit in memory (ex: the chunks from iter_csv).  The rows are sorted in runs of
+        chunk_rows, which are spilled to (a temporary directory within) spill_dir via pytils.pickler, and then merged.
+        """
+        if chunk_rows <= 0:
+            raise ValueError("Chunk rows must be positive.")
+
+        names, reverse = _sort_orders(name, reverse)
+        header = None
+        positions = None
+        rows = []
+        runs = []
+
+        with tempfile.TemporaryDirectory(dir=spill_dir) as temp_dir:
+            for table in tables:
+                if header is None:
+                    header = table.header()
+                    positions = [header.index(name) for name in names]
+                elif table.header() != header:
+                    raise ValueError("Cannot sort tables with different headers.")
+
+                for row in table.rows():
+                    rows += [row]
+
+                    if len(rows) == chunk_rows:
+                        runs += [_spill_run(rows, positions, reverse, os.path.join(temp_dir, str(len(runs))))]
+                        rows = []
+
+            if header is None:
+                return
+
+            # The final run never needs to be spilled.
+            sources = [pickler.load(run) for run in runs] + [iter(_sort_rows(rows, positions, reverse))]
+
+            if len(set(reverse)) == 1:
+                key = operator.itemgetter(*positions)
+                descending = reverse[0]
+            else:
+                key = lambda row: tuple([_Descending(row[p]) if d else row[p] for p, d in zip(positions, reverse)])
+                descending = False
+
+            rows = []
+
+            # Merging is stable across the sources, and the runs are in their original order.
+            for row in heapq.merge(*sources, key=key, reverse=descending):
+                rows += [row]
+
+                if len(rows) == chunk_rows:
+                    yield Table(header, rows)
+                    rows = []
+
+            if len(rows) > 0:
+                yield Table(header, rows)
+
+    @staticmethod
+    def _read_csv(reader, chunk_rows, conversions, rename_strategy, infer_types):
+        # Produces the tables of (up to) chunk_rows rows each, or a single table of all the rows when chunk_rows is None.
         header = None
         rows = []
 
@@ -339,7 +710,19 @@ class Table(object):
             else:
                 rows += [data]
 
-        base = Table(header, rows)
+                if len(rows) == chunk_rows:
+                    yield Table._chunk(header, rows, conversions, infer_types)
+                    rows = []
+
+        if len(rows) > 0 or chunk_rows is None:
+            yield Table._chunk(header, rows, conversions, infer_types)
+
+    @staticmethod
+    def _chunk(header, rows, conversions, infer_types):
+        if infer_types:
+            base = Table._from_columns(header, _columns_of(len(header), rows, _infer_column))
+        else:
+            base = Table(header, rows)
 
         if conversions is not None:
             return base.convert(conversions=conversions)
@@ -367,3 +750,1339 @@ class Table(object):
 
         return renamed_header
 
+
+class TableBuilder(object):
+    """Builds a table by appending rows, in amortized constant time per row.
+
+    The columns grow in place (as typed arrays for the names given a typecode, such as "q" or "d", and otherwise as
+    lists), and are handed over to the table by build() without a copy - after which the builder starts afresh.
+    """
+    def __init__(self, header, typecodes={}):
+        super(TableBuilder, self).__init__()
+        self._header = [h for h in header]
+        self._typecodes = [typecodes.get(name) for name in self._header]
+        self._reset()
+
+    def _reset(self):
+        self._columns = [[] if typecode is None else array(typecode) for typecode in self._typecodes]
+        self._appends = [column.append for column in self._columns]
+        self._height = 0
+
+    def append(self, row):
+        if len(row) != len(self._header):
+            raise ValueError("All rows must have exactly %d items.  " \
+                "Found one with %d items." % (len(self._header), len(row)))
+
+        try:
+            for append, value in zip(self._appends, row):
+                append(value)
+        except (TypeError, OverflowError) as e:
+            self._truncate()
+            raise e
+
+        self._height += 1
+        return self
+
+    def extend(self, rows):
+        rows = rows if isinstance(rows, list) else list(rows)
+        widths = set(map(len, rows))
+
+        if len(widths) > 1 or (len(widths) == 1 and len(self._header) not in widths):
+            raise ValueError("All rows must have exactly %d items.  " \
+                "Found one with %d items." % (len(self._header), min(widths - set([len(self._header)]))))
+
+        try:
+            for i, column in enumerate(self._columns):
+                column.extend(map(operator.itemgetter(i), rows))
+        except (TypeError, OverflowError) as e:
+            self._truncate()
+            raise e
+
+        self._height += len(rows)
+        return self
+
+    def _truncate(self):
+        # Undo a partially appended row (or rows), so that the columns stay aligned.
+        for column in self._columns:
+            del column[self._height:]
+
+    def height(self):
+        return self._height
+
+    def build(self):
+        table = Table._from_columns(self._header, self._columns)
+        self._reset()
+        return table
+
+
+class Vectorized(object):
+    """A column level function, for use with refine, convert or extend.
+
+    When NumPy is available, the function receives each column as a whole (as an ndarray) and produces a boolean mask
+    (for refine) or an array of values (for convert and extend).  Otherwise, the per-cell fallback function is used
+    instead.  NumPy ufuncs may also be passed to refine, convert or extend directly.
+    """
+    def __init__(self, func, fallback=None):
+        super(Vectorized, self).__init__()
+        self.func = func
+        self.fallback = fallback
+
+    def __call__(self, *values):
+        # The per-cell form.
+        if self.fallback is not None:
+            return self.fallback(*values)
+
+        if numpy is None:
+            raise ValueError("Vectorized function requires NumPy, or otherwise a fallback.")
+
+        return self.func(*values)
+
+
+class _Slice(object):
+    # A view of the rows [start, stop) of a (compact) column.
+    def __init__(self, column, start, stop):
+        super(_Slice, self).__init__()
+        self.column = column
+        self.start = start
+        self.stop = stop
+
+    def compact(self):
+        return _compact(self.column[self.start:self.stop])
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+
+            if step != 1:
+                return self.compact()[index]
+
+            return _slice(self, start, max(start, stop))
+
+        if index < 0:
+            index += len(self)
+
+        if index < 0 or index >= len(self):
+            raise IndexError("column index out of range")
+
+        return self.column[self.start + index]
+
+    def __iter__(self):
+        return map(self.column.__getitem__, range(self.start, self.stop))
+
+
+class _Chain(object):
+    # A view of the concatenation of (compact or sliced) columns.
+    def __init__(self, segments):
+        super(_Chain, self).__init__()
+        self.segments = segments
+        self.offsets = [0]
+
+        for segment in segments:
+            self.offsets += [self.offsets[-1] + len(segment)]
+
+    def compact(self):
+        compacts = [_compact(segment) for segment in self.segments]
+        typecodes = set([column.typecode if isinstance(column, array) else None for column in compacts])
+
+        if len(typecodes) == 1 and None not in typecodes:
+            column = array(typecodes.pop())
+
+            for compacted in compacts:
+                column += compacted
+
+            return column
+
+        return _as_column([value for compacted in compacts for value in compacted])
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+
+            if step != 1:
+                return self.compact()[index]
+
+            return _slice(self, start, max(start, stop))
+
+        if index < 0:
+            index += len(self)
+
+        if index < 0 or index >= len(self):
+            raise IndexError("column index out of range")
+
+        s = bisect_right(self.offsets, index) - 1
+        return self.segments[s][index - self.offsets[s]]
+
+    def __iter__(self):
+        return chain.from_iterable(self.segments)
+
+
+def _slice(column, start, stop):
+    if start == 0 and stop == len(column):
+        return column
+    elif isinstance(column, _Categorical):
+        return column[start:stop]
+    elif isinstance(column, _Slice):
+        return _Slice(column.column, column.start + start, column.start + stop)
+    elif isinstance(column, _Chain):
+        segments = []
+
+        for segment, offset in zip(column.segments, column.offsets):
+            if offset < stop and offset + len(segment) > start:
+                segments += [_slice(segment, max(0, start - offset), min(len(segment), stop - offset))]
+
+        return _chain(segments)
+
+    return _Slice(column, start, stop)
+
+
+def _chain(columns):
+    segments = []
+
+    for column in columns:
+        if isinstance(column, _Chain):
+            segments += column.segments
+        elif len(column) > 0:
+            segments += [column]
+
+    if len(segments) == 0:
+        return []
+    elif len(segments) == 1:
+        return segments[0]
+
+    return _Chain(segments)
+
+
+def _compact(column):
+    if isinstance(column, _Categorical):
+        return _Categorical(_compact(column.codes), column.values, column.lookup)
+    elif isinstance(column, memoryview):
+        compacted = array(column.format)
+        compacted.frombytes(column.cast("B"))
+        return compacted
+    elif isinstance(column, _Slice) or isinstance(column, _Chain) or isinstance(column, _Strings) \
+            or isinstance(column, _Pickled):
+        return column.compact()
+
+    return column
+
+
+class _Categorical(object):
+    # A dictionary encoded column: the distinct values, and a (small) integer code per row referring to them.
+    def __init__(self, codes, values, lookup):
+        super(_Categorical, self).__init__()
+        self.codes = codes
+        self.values = values
+        self.lookup = lookup
+
+    def positions(self, value):
+        code = self._code(value)
+
+        if code is None:
+            return []
+
+        return [position for position, c in enumerate(self.codes) if c == code]
+
+    def _code(self, value):
+        # The values are all hashable, so an unhashable value matches none of them.
+        try:
+            return self.lookup.get(value)
+        except TypeError:
+            return None
+
+    def recode(self, other):
+        # The codes of this column, translated into the other's dictionary (-1 for values the other doesn't have).
+        translation = [other.lookup.get(value, -1) for value in self.values]
+        return [translation[code] for code in self.codes]
+
+    def ranks(self):
+        # The sort order of each code's value.
+        order = sorted(range(0, len(self.values)), key=self.values.__getitem__)
+        ranks = [0 for code in order]
+
+        for rank, code in enumerate(order):
+            ranks[code] = rank
+
+        return ranks
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return _Categorical(self.codes[index], self.values, self.lookup)
+
+        return self.values[self.codes[index]]
+
+    def __iter__(self):
+        return map(self.values.__getitem__, self.codes)
+
+
+def _categorize(column):
+    if isinstance(column, _Categorical):
+        return column
+
+    # Values of different types may be equal (ex: 1, 1.0 and True), and so would share a code.
+    kinds = set(map(type, column)) - set([type(None)])
+
+    if len(kinds) > 1:
+        raise ValueError("Cannot categorize a column of mixed types: [%s]." \
+            % ",".join(sorted([kind.__name__ for kind in kinds])))
+
+    lookup = {}
+    codes = [lookup.setdefault(value, len(lookup)) for value in column]
+
+    if len(lookup) <= 2**8:
+        typecode = "B"
+    elif len(lookup) <= 2**16:
+        typecode = "H"
+    else:
+        typecode = "q"
+
+    return _Categorical(array(typecode, codes), list(lookup.keys()), lookup)
+
+
+def _sort_orders(names, reverse):
+    names = [names] if isinstance(names, str) else [name for name in names]
+    reverse = [reverse for name in names] if isinstance(reverse, bool) else [descending for descending in reverse]
+
+    if len(names) == 0:
+        raise ValueError("Must sort by at least one name.")
+
+    if len(reverse) != len(names):
+        raise ValueError("Must specify the reverse for each of the %d names (found %d)." % (len(names), len(reverse)))
+
+    return names, reverse
+
+
+def _sort_rows(rows, positions, reverse):
+    for position, descending in reversed(list(zip(positions, reverse))):
+        rows.sort(key=operator.itemgetter(position), reverse=descending)
+
+    return rows
+
+
+def _spill_run(rows, positions, reverse, run_path):
+    # Each row is pickled individually, so that merging streams the runs a row at a time.
+    pickler.save(_sort_rows(rows, positions, reverse), run_path, offsets=True)
+    return run_path
+
+
+class _Descending(object):
+    # Inverts the order of a value, for merging keys which mix ascending and descending columns.
+    __slots__ = ["value"]
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _sort_key(column):
+    if isinstance(column, _Categorical):
+        ranks = column.ranks()
+        codes = column.codes
+        return lambda position: ranks[codes[position]]
+    elif isinstance(column, _Chain):
+        # Looking up each position across the segments is slow, so sort over a compact copy instead.
+        column = column.compact()
+
+    return column.__getitem__
+
+
+class _Strings(object):
+    # A column of strings, stored as the concatenation of their utf-8 encodings and the offsets between them.
+    def __init__(self, offsets, values):
+        super(_Strings, self).__init__()
+        self.offsets = offsets
+        self.values = values
+
+    def compact(self):
+        return [value for value in self]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+
+            if step != 1:
+                return self.compact()[index]
+
+            return _Strings(self.offsets[start:max(start, stop) + 1], self.values)
+
+        if index < 0:
+            index += len(self)
+
+        if index < 0 or index >= len(self):
+            raise IndexError("column index out of range")
+
+        return str(self.values[self.offsets[index]:self.offsets[index + 1]], "utf-8")
+
+    def __iter__(self):
+        values = self.values
+        offsets = self.offsets
+
+        for index in range(0, len(self)):
+            yield str(values[offsets[index]:offsets[index + 1]], "utf-8")
+
+
+class _Pickled(object):
+    # A column of arbitrary values, only unpickled the first time it is used.
+    def __init__(self, path, height):
+        super(_Pickled, self).__init__()
+        self.path = path
+        self.height = height
+        self.values = None
+
+    def compact(self):
+        if self.values is None:
+            with open(self.path, "rb") as fh:
+                self.values = pickle.load(fh)
+
+        return self.values
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, index):
+        return self.compact()[index]
+
+    def __iter__(self):
+        return iter(self.compact())
+
+
+def _save_column(column, path, i):
+    column = _compact(column)
+    typecode = _typecode(column)
+
+    if isinstance(column, _Categorical):
+        with open(os.path.join(path, "%d.codes" % i), "wb") as fh:
+            fh.write(column.codes)
+
+        with open(os.path.join(path, "%d.pickle" % i), "wb") as fh:
+            pickle.dump(column.values, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+        return "%s/%s" % (CATEGORY_KIND, _typecode(column.codes))
+    elif typecode is not None:
+        with open(os.path.join(path, "%d.column" % i), "wb") as fh:
+            fh.write(column)
+
+        return typecode
+    elif len(column) > 0 and set(map(type, column)) == {str}:
+        offsets = array("q", [0])
+        total = 0
+
+        with open(os.path.join(path, "%d.values" % i), "wb") as fh:
+            for value in column:
+                encoded = value.encode("utf-8")
+                fh.write(encoded)
+                total += len(encoded)
+                offsets.append(total)
+
+        with open(os.path.join(path, "%d.offsets" % i), "wb") as fh:
+            fh.write(offsets)
+
+        return STRING_KIND
+
+    with open(os.path.join(path, "%d.pickle" % i), "wb") as fh:
+        pickle.dump(_as_list(column), fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return PICKLE_KIND
+
+
+def _open_column(path, i, kind, height, mapped):
+    if kind == PICKLE_KIND:
+        return _Pickled(os.path.join(path, "%d.pickle" % i), height)
+    elif kind.startswith(CATEGORY_KIND):
+        with open(os.path.join(path, "%d.pickle" % i), "rb") as fh:
+            values = pickle.load(fh)
+
+        codes = _read_buffer(os.path.join(path, "%d.codes" % i), kind.split("/")[1], mapped)
+        return _Categorical(codes, values, {value: code for code, value in enumerate(values)})
+    elif kind == STRING_KIND:
+        return _Strings(_read_buffer(os.path.join(path, "%d.offsets" % i), "q", mapped),
+            _read_buffer(os.path.join(path, "%d.values" % i), "B", mapped))
+
+    return _read_buffer(os.path.join(path, "%d.column" % i), kind, mapped)
+
+
+def _read_buffer(file_path, typecode, mapped):
+    size = os.path.getsize(file_path)
+
+    if not mapped or size == 0:
+        # Memory maps cannot be empty.
+        buffer = array(typecode)
+
+        with open(file_path, "rb") as fh:
+            buffer.frombytes(fh.read())
+
+        return buffer
+
+    with open(file_path, "rb") as fh:
+        # The mapping remains valid after the file is closed - pages are only read in as they are used.
+        return memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+
+class Reducer(object):
+    """A (partial) reduction over the values of a group.
+
+    The reduce function produces a partial state from a list of values, merge combines two states (from consecutive
+    chunks of the input, in order), and finish produces the aggregate value from the final state.
+    """
+    def __init__(self, reduce, merge, finish=lambda state: state):
+        super(Reducer, self).__init__()
+        self.reduce = reduce
+        self.merge = merge
+        self.finish = finish
+
+
+_REDUCERS = {
+    SUM: Reducer(sum, operator.add),
+    COUNT: Reducer(len, operator.add),
+    MEAN: Reducer(lambda values: (sum(values), len(values)),
+        lambda state, other: (state[0] + other[0], state[1] + other[1]),
+        lambda state: state[0] / float(state[1])),
+    MIN: Reducer(min, min),
+    MAX: Reducer(max, max),
+    FIRST: Reducer(lambda values: values[0], lambda state, other: state),
+    LAST: Reducer(lambda values: values[-1], lambda state, other: other),
+}
+
+
+class Grouping(object):
+    def __init__(self, table, names):
+        super(Grouping, self).__init__()
+        self.table = table
+        self.names = names
+
+    def aggregate(self, aggregations):
+        """Produce a table with one row per group: the group's values followed by its aggregates.
+
+        Aggregations map each target name to a (name, reducer) pair, where the reducer is one of SUM, COUNT, MEAN,
+        MIN, MAX, FIRST, LAST, a Reducer, or a function over the list of the group's values.
+        """
+        return Aggregation(self.names, aggregations).update(self.table).result()
+
+
+class Aggregation(object):
+    """A group by aggregation which may be updated with any number of tables (ie: the chunks of a stream).
+    """
+    def __init__(self, names, aggregations):
+        super(Aggregation, self).__init__()
+        self.names = names
+        self.targets = []
+        self.sources = []
+        self.reducers = []
+        self.states = {}
+
+        for target, (name, reducer) in aggregations.items():
+            self.targets += [target]
+            self.sources += [name]
+
+            if isinstance(reducer, Reducer):
+                self.reducers += [reducer]
+            elif reducer in _REDUCERS:
+                self.reducers += [_REDUCERS[reducer]]
+            elif callable(reducer):
+                self.reducers += [Reducer(list, operator.add, reducer)]
+            else:
+                raise ValueError("Unknown reducer '%s'." % reducer)
+
+    def update(self, table):
+        groups = {}
+        keys = table._keys(self.names)
+        decode = None
+
+        if isinstance(keys, _Categorical):
+            # Group on the codes, and only decode the key of each group.
+            decode = keys.values
+            keys = keys.codes
+
+        for position, key in enumerate(keys):
+            positions = groups.get(key)
+
+            if positions is None:
+                groups[key] = [position]
+            else:
+                positions.append(position)
+
+        columns = [table._columns[table._find(name)] for name in self.sources]
+
+        for key, positions in groups.items():
+            if decode is not None:
+                key = decode[key]
+
+            states = [reducer.reduce(_gather(column, positions)) for reducer, column in zip(self.reducers, columns)]
+
+            if key in self.states:
+                self.states[key] = [reducer.merge(state, other) \
+                    for reducer, state, other in zip(self.reducers, self.states[key], states)]
+            else:
+                self.states[key] = states
+
+        return self
+
+    def result(self):
+        if len(self.names) == 1:
+            keys = [[key] for key in self.states.keys()]
+        else:
+            keys = [list(key) for key in self.states.keys()]
+
+        aggregates = [[reducer.finish(state) for reducer, state in zip(self.reducers, states)] \
+            for states in self.states.values()]
+        return Table(self.names + self.targets, [key + aggregate for key, aggregate in zip(keys, aggregates)])
+
+
+class _Index(object):
+    def __init__(self, column, kind):
+        super(_Index, self).__init__()
+        self.kind = kind
+
+        if kind == HASH:
+            self.positions = {}
+
+            for position, value in enumerate(column):
+                self.positions.setdefault(value, []).append(position)
+        else:
+            order = sorted(range(0, len(column)), key=column.__getitem__)
+            self.values = _gather(column, order)
+            self.positions = array("q", order)
+
+    def lookup(self, value):
+        if self.kind == HASH:
+            return self.positions.get(value, [])
+
+        return self.positions[bisect_left(self.values, value):bisect_right(self.values, value)]
+
+    def range(self, lower, upper):
+        start = 0 if lower is None else bisect_left(self.values, lower)
+        end = len(self.values) if upper is None else bisect_right(self.values, upper)
+        return self.positions[start:end]
+
+
+class LazyTable(object):
+    """A plan of table operations, recorded now but only run on collect() (or rows()).
+
+    Only the columns that the remainder of the plan makes use of are read, and conversions and extensions whose results
+    are never used are not evaluated at all.  Refines run ahead of the operations which don't affect them, and the
+    operations a refine depends on run over chunks of the rows, rather than building whole intermediate columns.
+    """
+    def __init__(self, table, steps, header):
+        super(LazyTable, self).__init__()
+        self._table = table
+        self._steps = steps
+        self._header = header
+
+    def refine(self, name=None, func_match=None, refinements=None):
+        refinements = _refinements(name, func_match, refinements)
+        self._check(refinements.keys())
+        return self._then(("refine", refinements), self._header)
+
+    def convert(self, name=None, func=None, conversions=None):
+        conversions = _conversions(name, func, conversions)
+        self._check(conversions.keys())
+        return self._then(("convert", conversions), self._header)
+
+    def extend(self, names=None, func=None, target=None, extensions=None):
+        extensions = _extensions(names, func, target, extensions)
+
+        for ext in extensions:
+            self._check(ext["names"])
+
+        header = self._header + [ext["target"] for ext in extensions]
+
+        if len(set(header)) < len(header):
+            raise ValueError("Each header must be uniquely named.  " \
+                "Found duplicates: [%s]." % ",".join([h for h, count in Counter(header).items() if count > 1]))
+
+        return self._then(("extend", extensions), header)
+
+    def narrow(self, names, unique=False):
+        self._check(names)
+        return self._then(("narrow", [name for name in names], unique), [name for name in names])
+
+    def drop(self, names, unique=False):
+        columns = self.header()
+
+        for name in names:
+            columns.remove(name)
+
+        return self.narrow(columns, unique)
+
+    def sort(self, name, reverse=False):
+        names, reverse = _sort_orders(name, reverse)
+        self._check(names)
+        return self._then(("sort", names, reverse), self._header)
+
+    def header(self):
+        return [h for h in self._header]
+
+    def rows(self, names=None, limit=None, unique=False):
+        if names is not None or unique:
+            return self.narrow(self._header if names is None else names, unique).collect().rows(limit=limit)
+
+        return self.collect().rows(limit=limit)
+
+    def collect(self):
+        # Work backwards through the plan to find which names are still needed after each step.
+        lives = []
+        live = set(self._header)
+
+        for step in reversed(self._steps):
+            lives = [live] + lives
+            live = _live_before(step, live)
+
+        table = self._table
+        stage = []
+
+        for step, live in zip(self._steps, lives):
+            if step[0] == "sort":
+                table = _run_stage(table, stage, _live_before(step, live)).sort(step[1], step[2])
+                stage = []
+            else:
+                stage += [(step, live)]
+
+        return _run_stage(table, stage, set(self._header))
+
+    def _then(self, step, header):
+        return LazyTable(self._table, self._steps + [step], header)
+
+    def _check(self, names):
+        for name in names:
+            if name not in self._header:
+                raise ValueError("No column found by name '%s'." % name)
+
+    def __repr__(self):
+        return "LazyTable: (width=%d, steps=%d)" % (len(self._header), len(self._steps))
+
+
+def _live_before(step, live):
+    kind = step[0]
+
+    if kind == "refine":
+        return live | set(step[1].keys())
+    elif kind == "extend":
+        before = set(live)
+
+        for ext in step[1]:
+            if ext["target"] in live:
+                before.remove(ext["target"])
+                before |= set(ext["names"])
+
+        return before
+    elif kind == "narrow":
+        # Distinct rows are decided by all of the narrowed names, whether or not they are used afterwards.
+        return set(step[1]) if step[2] else live & set(step[1])
+    elif kind == "sort":
+        return live | set(step[1])
+
+    # A conversion only needs its column if the column is needed afterwards anyway.
+    return live
+
+
+def _run_stage(table, stage, output):
+    # Refines on columns which no earlier step of the stage changes are run first.  The span of steps from a conversion
+    # (or extension) up to the refine which reads it are run a chunk of rows at a time, so that their intermediate
+    # columns are never built at full height.  Otherwise, the steps run just as they would on a table.
+    live = output if len(stage) == 0 else _live_before(stage[0][0], stage[0][1])
+    names = [name for name in table.header() if name in live]
+
+    if len(names) > 0:
+        working = Table._from_columns(names, [table._columns[table._find(name)] for name in names])
+        # The narrowed table has the same rows, so the indexes still apply.
+        working._indexes = {name: table._indexes[name] for name in names if name in table._indexes}
+    else:
+        # Without any columns, the table wouldn't have any rows either.
+        working = table
+
+    hoisted, stage = _hoist_refines(stage)
+
+    for refinements in hoisted:
+        working = working.refine(refinements=refinements)
+
+    start, stop = _fused_span(stage)
+
+    for step, after in stage[:start]:
+        working = _run_step(working, step, after)
+
+    if start < stop:
+        working = _run_chunked(working, stage[start:stop])
+
+    for step, after in stage[stop:]:
+        working = _run_step(working, step, after)
+
+    return working.narrow([name for name in working.header() if name in output])
+
+
+def _hoist_refines(stage):
+    # Separates the refines which may be run before all of the stage's other steps.
+    changed = set()
+    hoisted = []
+    remaining = []
+
+    for step, after in stage:
+        if step[0] == "refine" and len(changed & set(step[1].keys())) == 0:
+            hoisted += [step[1]]
+            continue
+        elif step[0] == "convert":
+            changed |= set(step[1].keys())
+        elif step[0] == "extend":
+            changed |= set([ext["target"] for ext in step[1]])
+
+        remaining += [(step, after)]
+
+    return hoisted, remaining
+
+
+def _fused_span(stage):
+    # The [start, stop) of the steps from the first conversion or extension a refine reads, through to the last refine.
+    start = None
+    stop = 0
+    changes = []
+
+    for i, (step, after) in enumerate(stage):
+        if step[0] == "refine":
+            reads = set(step[1].keys())
+            writers = [j for j, changed in changes if len(changed & reads) > 0]
+
+            if len(writers) > 0:
+                start = min(writers + ([] if start is None else [start]))
+                stop = i + 1
+        elif step[0] == "convert":
+            changes += [(i, set(step[1].keys()))]
+        elif step[0] == "extend":
+            changes += [(i, set([ext["target"] for ext in step[1]]))]
+
+    return (0, 0) if start is None else (start, stop)
+
+
+def _run_step(table, step, after):
+    kind = step[0]
+
+    if kind == "refine":
+        return table.refine(refinements=step[1])
+    elif kind == "convert":
+        conversions = {name: func for name, func in step[1].items() if name in after}
+        return table if len(conversions) == 0 else table.convert(conversions=conversions)
+    elif kind == "extend":
+        extensions = [ext for ext in step[1] if ext["target"] in after]
+        return table if len(extensions) == 0 else table.extend(extensions=extensions)
+
+    # Any names which were never needed (ie: unused extensions) aren't in the table.
+    header = table.header()
+    return table.narrow([name for name in step[1] if name in header], step[2])
+
+
+def _run_chunked(table, stage):
+    # Distinct rows are decided across the whole table, as are the rows of a table without any columns.
+    if table.width() == 0 or any([step[0] == "narrow" and step[2] for step, after in stage]):
+        bounds = [(0, table.height())]
+    else:
+        bounds = [(start, min(start + CHUNK_ROWS, table.height())) for start in range(0, table.height(), CHUNK_ROWS)]
+
+    results = []
+
+    for start, stop in bounds:
+        # A compact copy of the chunk is quicker to work through than a view of it.
+        chunk = Table._from_columns(table.header(), [_compact(_slice(column, start, stop)) for column in table._columns])
+
+        for step, after in stage:
+            chunk = _run_step(chunk, step, after)
+
+        results += [chunk]
+
+    if len(results) == 1:
+        return results[0]
+    elif len(results) == 0:
+        header = table.header()
+
+        for step, after in stage:
+            header = _run_step(Table._from_columns(header, [[] for name in header]), step, after).header()
+
+        return Table._from_columns(header, [[] for name in header])
+
+    header = results[0].header()
+    return Table._from_columns(header, [_compact(_chain([result._columns[i] for result in results])) \
+        for i in range(0, len(header))])
+
+
+def _refinements(name, func_match, refinements):
+    if refinements is not None:
+        if name is not None or func_match is not None:
+            raise ValueError("May only define (name, func_match) or " \
+                "refinements, but not both.")
+
+        if not isinstance(refinements, dict):
+            raise TypeError("refinements must be a dict.")
+
+        return refinements
+    elif name is None or func_match is None:
+        raise ValueError("Must define either (name, func_match) or " \
+            "refinements.")
+
+    return {name: func_match}
+
+
+def _conversions(name, func, conversions):
+    if conversions is not None:
+        if name is not None or func is not None:
+            raise ValueError("May only define (name, func) or " \
+                "conversions, but not both.")
+
+        if not isinstance(conversions, dict):
+            raise TypeError("Conversions must be a dict.")
+
+        return conversions
+    elif name is None or func is None:
+        raise ValueError("Must define either (name, func) or " \
+            "conversions.")
+
+    return {name: func}
+
+
+def _extensions(names, func, target, extensions):
+    if extensions is not None:
+        if names is not None or func is not None and target is not None:
+            raise ValueError("May only define (names, func, target) or " \
+                "extensions, but not both.")
+
+        if not isinstance(extensions, list):
+            raise TypeError("Extensions must be a list.")
+
+        return extensions
+    elif names is None or func is None or target is None:
+        raise ValueError("Must define either (names, func, target) or " \
+            "extensions.")
+
+    return [{
+        "names": names,
+        "func": func,
+        "target": target
+    }]
+
+
+def _columns_of(width, rows, to_column):
+    # The rows are iterated once per column, so generators (and the like) are first drawn out.
+    rows = rows if isinstance(rows, list) else list(rows)
+
+    for row in rows:
+        if width != len(row):
+            raise ValueError("All rows must have exactly %d items.  " \
+                "Found one with %d items." % (width, len(row)))
+
+    # Build one column at a time, so that only a single intermediate list is alive at once.
+    return [to_column([row[i] for row in rows]) for i in range(0, width)]
+
+
+def _parse_date(value):
+    return date.fromisoformat(value)
+
+
+_PARSERS = [int, float, str_as_bool, _parse_date]
+
+
+def _infer_column(values):
+    # Find the first parser which fits an evenly spaced sample of the (non-empty) values, and then parse the whole
+    # column with it - falling back to the subsequent parsers should the sample have been misleading.
+    stride = max(1, len(values) // INFER_SAMPLE)
+    sample = [value for value in values[::stride] if value != ""]
+
+    if len(sample) == 0:
+        return values
+
+    for i, parser in enumerate(_PARSERS):
+        try:
+            for value in sample:
+                parser(value)
+        except ValueError:
+            continue
+
+        for parser in _PARSERS[i:]:
+            try:
+                if "" in values:
+                    return [None if value == "" else parser(value) for value in values]
+
+                return _as_column(map(parser, values))
+            except ValueError:
+                pass
+
+        break
+
+    return values
+
+
+def _as_column(values):
+    # Homogeneous int or float data is packed into a typed array (8 bytes per value rather than a reference to a boxed
+    # object); anything else is kept as a list.
+    if not isinstance(values, list):
+        values = list(values)
+
+    if len(values) > 0:
+        kinds = set(map(type, values))
+
+        if kinds == {int}:
+            try:
+                return array("q", values)
+            except OverflowError:
+                pass
+        elif kinds == {float}:
+            return array("d", values)
+
+    return values
+
+
+def _describe(column):
+    # Produces [count, nulls, distinct, min, max, mean, stddev] + quartiles.
+    if _typecode(column) is not None:
+        # Typed columns have no nulls, and are all numeric - so lean on the (C implemented) builtins.
+        count = len(column)
+
+        if count == 0:
+            return [0, 0, 0, None, None, None, None] + [None for q in QUARTILES]
+
+        mean = math.fsum(column) / count
+        # Summing the squared deviations (rather than the squares) keeps the precision of values with a large offset.
+        variance = math.fsum((value - mean) ** 2 for value in column) / count
+        sampler = random.Random(0)
+        sample = [column[i] for i in sampler.sample(range(0, count), min(count, DESCRIBE_SAMPLE))]
+        return [count, 0, len(set(column)), min(column), max(column), mean, math.sqrt(variance)] \
+            + _quartiles(sample)
+
+    count = 0
+    nulls = 0
+    distinct = set()
+    unhashable = []
+    minimum = None
+    maximum = None
+    comparable = True
+    numeric = True
+    mean = 0.0
+    deviations = 0.0
+    sample = []
+    sampler = random.Random(0)
+
+    for value in column:
+        if value is None:
+            nulls += 1
+            continue
+
+        count += 1
+
+        try:
+            distinct.add(value)
+        except TypeError:
+            if value not in unhashable:
+                unhashable += [value]
+
+        if numeric:
+            if type(value) is int or type(value) is float:
+                # Welford's running mean and sum of squared deviations.
+                delta = value - mean
+                mean += delta / count
+                deviations += delta * (value - mean)
+            else:
+                numeric = False
+
+        if comparable:
+            try:
+                if minimum is None or value < minimum:
+                    minimum = value
+
+                if maximum is None or value > maximum:
+                    maximum = value
+            except TypeError:
+                comparable = False
+
+            # Reservoir sample the values for the quartiles.
+            if len(sample) < DESCRIBE_SAMPLE:
+                sample += [value]
+            else:
+                i = sampler.randint(0, count - 1)
+
+                if i < DESCRIBE_SAMPLE:
+                    sample[i] = value
+
+    if count == 0 or not comparable:
+        minimum = None
+        maximum = None
+        sample = []
+
+    if count > 0 and numeric:
+        stddev = math.sqrt(deviations / count)
+    else:
+        mean = None
+        stddev = None
+
+    return [count, nulls, len(distinct) + len(unhashable), minimum, maximum, mean, stddev] + _quartiles(sample)
+
+
+def _quartiles(sample):
+    if len(sample) == 0:
+        return [None for q in QUARTILES]
+
+    ordered = sorted(sample)
+    return [ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUARTILES]
+
+
+def _equality_test(column, value):
+    if isinstance(column, _Categorical):
+        code = column._code(value)
+        codes = column.codes
+        return lambda position: codes[position] == code
+
+    return lambda position: column[position] == value
+
+
+def _function_test(column, func):
+    return lambda position: func(column[position])
+
+
+def _order_tests(tests, positions, selectivity):
+    # Order the (name, test)s by their (hinted, or otherwise sampled) pass rates, most selective first.
+    sample = positions[::max(1, len(positions) // SELECTIVITY_SAMPLE)]
+    pass_rates = {}
+
+    for name, test in tests:
+        if selectivity is not None and name in selectivity:
+            pass_rates[name] = selectivity[name]
+        elif len(sample) > 0:
+            pass_rates[name] = len([position for position in sample if test(position)]) / float(len(sample))
+        else:
+            pass_rates[name] = 0.0
+
+    return sorted(tests, key=lambda item: pass_rates[item[0]])
+
+
+def _apply(workers, height, chunk_func, sources, funcs):
+    # Produces chunk_func(0, height, sources, funcs), except split over chunks of the rows run in worker processes.
+    if workers is not None and workers <= 0:
+        raise ValueError("Workers must be positive.")
+
+    if workers is None or workers == 1 or len(funcs) == 0:
+        return chunk_func(0, height, sources, funcs)
+
+    chunk_size = max(1, int(math.ceil(height / float(workers * CHUNKS_PER_WORKER))))
+    starts = range(0, height, chunk_size)
+    stops = [min(start + chunk_size, height) for start in starts]
+    results = [[] for func in funcs]
+
+    # The workers inherit the (potentially unpicklable) functions and the columns, rather than having them sent.
+    with fork_pool(workers, (chunk_func, sources, funcs)) as executor:
+        # Results are produced in order, and any error raised in a worker is re-raised here.
+        for chunk in executor.map(_run_chunk, starts, stops):
+            for values, chunk_values in zip(results, chunk):
+                values.extend(chunk_values)
+
+    return results
+
+
+def _run_chunk(start, stop):
+    chunk_func, sources, funcs = pool_state()
+    return chunk_func(start, stop, sources, funcs)
+
+
+def _convert_chunk(start, stop, columns, funcs):
+    return [[func(v) for v in column[start:stop]] for column, func in zip(columns, funcs)]
+
+
+def _extend_chunk(start, stop, sources, funcs):
+    values = []
+
+    for columns, func in zip(sources, funcs):
+        if len(columns) > 0:
+            values += [[func(*data) for data in zip(*[column[start:stop] for column in columns])]]
+        else:
+            values += [[func() for i in range(start, stop)]]
+
+    return values
+
+
+def _typecode(column):
+    # Typed columns are arrays, or memoryviews of the same format (ie: when memory mapped).
+    if isinstance(column, array):
+        return column.typecode
+    elif isinstance(column, memoryview):
+        return column.format
+
+    return None
+
+
+def _vectorizable(func):
+    return numpy is not None and (isinstance(func, Vectorized) or isinstance(func, numpy.ufunc))
+
+
+def _as_ndarray(column):
+    if isinstance(column, _Slice) and _typecode(column.column) is not None:
+        return _as_ndarray(column.column)[column.start:column.stop]
+    elif isinstance(column, _Slice) or isinstance(column, _Chain):
+        column = column.compact()
+
+    if _typecode(column) is not None and _typecode(column) in NUMERIC_TYPECODES:
+        # A read-only view of the array's buffer, without any copying (the typecodes are also numpy's dtype codes).
+        ndarray = numpy.frombuffer(column, dtype=numpy.dtype(_typecode(column)))
+        ndarray.flags.writeable = False
+        return ndarray
+
+    return numpy.array(column)
+
+
+def _from_ndarray(ndarray, height):
+    ndarray = numpy.broadcast_to(ndarray, (height,))
+
+    if ndarray.dtype.kind in "iu":
+        column = array("q")
+        column.frombytes(ndarray.astype(numpy.int64).tobytes())
+        return column
+    elif ndarray.dtype.kind == "f":
+        column = array("d")
+        column.frombytes(ndarray.astype(numpy.float64).tobytes())
+        return column
+
+    return _as_column(ndarray.tolist())
+
+
+def _as_list(column, limit=None):
+    if isinstance(column, _Slice) or isinstance(column, _Chain):
+        column = (column if limit is None else column[:limit]).compact()
+        limit = None
+
+    if _typecode(column) is not None:
+        return column.tolist() if limit is None else column[:limit].tolist()
+    elif isinstance(column, list):
+        return column[:limit]
+
+    return list(islice(column, limit))
+
+
+def _gather(column, positions, padded=False):
+    if padded:
+        # A position of None produces a None value (ie: for the unmatched side of an outer join).
+        return _as_column([None if position is None else column[position] for position in positions])
+
+    if isinstance(column, _Slice):
+        start = column.start
+        positions = [position + start for position in positions]
+        column = column.column
+
+    if isinstance(column, _Categorical):
+        return _Categorical(array(_typecode(column.codes), map(column.codes.__getitem__, positions)), column.values,
+            column.lookup)
+
+    if isinstance(column, _Chain):
+        # Typed segments (ie: merged tables) stay typed when they agree on the typecode.
+        typecodes = set([_typecode(segment.column if isinstance(segment, _Slice) else segment) \
+            for segment in column.segments])
+
+        if len(typecodes) == 1 and None not in typecodes:
+            # Looking up each position across the segments is slow, so gather most of the rows from a compact copy.
+            source = column.compact() if len(positions) * 2 >= len(column) else column
+            return array(typecodes.pop(), map(source.__getitem__, positions))
+
+        return _as_column([column[position] for position in positions])
+
+    if _typecode(column) is not None:
+        return array(_typecode(column), map(column.__getitem__, positions))
+
+    return [column[position] for position in positions]
+
+
+def _distinct(rows):
+    # Produces the (position, row) of each row the first time it is seen.
+    # Duplicates are found by hashing, falling back to a linear search only for any unhashable rows.
+    seen = set()
+    unhashable = []
+
+    for position, row in enumerate(rows):
+        try:
+            if row in seen:
+                continue
+
+            seen.add(row)
+        except TypeError:
+            if row in unhashable:
+                continue
+
+            unhashable.append(row)
+
+        yield position, row
+
+
+def _hash_join(build_keys, probe_keys, keep_build, keep_probe):
+    # Produces the matching (build, probe) position pairs - unmatched positions are paired with None when kept.
+    index = {}
+
+    for position, key in enumerate(build_keys):
+        index.setdefault(key, []).append(position)
+
+    build_positions = []
+    probe_positions = []
+    matched = set() if keep_build else None
+
+    for position, key in enumerate(probe_keys):
+        matches = index.get(key)
+
+        if matches is not None:
+            build_positions.extend(matches)
+            probe_positions.extend([position] * len(matches))
+
+            if keep_build:
+                matched.add(key)
+        elif keep_probe:
+            build_positions.append(None)
+            probe_positions.append(position)
+
+    if keep_build:
+        for position, key in enumerate(build_keys):
+            if key not in matched:
+                build_positions.append(position)
+                probe_positions.append(None)
+
+    return build_positions, probe_positions
+
+
+def _order_pairs(positions, other_positions, height):
+    # Stably reorders the (position, other position) pairs by position, with a counting sort.  Pairs without a position
+    # (ie: the unmatched rows of the other table) go last.
+    starts = array("q", bytes(8 * (height + 1)))
+
+    for position in positions:
+        if position is not None:
+            starts[position + 1] += 1
+
+    for i in range(1, height + 1):
+        starts[i] += starts[i - 1]
+
+    end = starts[height]
+    ordered = [None] * len(positions)
+    other_ordered = [None] * len(positions)
+
+    for position, other_position in zip(positions, other_positions):
+        if position is None:
+            slot = end
+            end += 1
+        else:
+            slot = starts[position]
+            starts[position] += 1
+
+        ordered[slot] = position
+        other_ordered[slot] = other_position
+
+    return ordered, other_ordered
+
+
+def _column_equals(column, other):
+    if isinstance(column, array) and isinstance(other, array) and column.typecode == other.typecode:
+        return column == other
+
+    return len(column) == len(other) and _as_list(column) == _as_list(other)
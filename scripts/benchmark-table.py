@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from argparse import ArgumentParser
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from pytils.table import Table
+
+
+DEFAULT_ROWS = [10**3, 10**4, 10**5, 10**6]
+CATEGORIES = 100
+JOIN_KEYS = 1000
+
+
+def main(argv):
+    ap = ArgumentParser(prog="benchmark-table.py")
+    ap.add_argument("--rows", "-r", nargs="+", type=int, default=DEFAULT_ROWS,
+        help="Row counts to benchmark, defaults to %s." % " ".join([str(r) for r in DEFAULT_ROWS]))
+    ap.add_argument("--width", "-w", type=int, default=5, help="Columns in the synthetic tables (at least 4), defaults to 5.")
+    ap.add_argument("--operations", "-o", nargs="+", choices=list(OPERATIONS.keys()), default=list(OPERATIONS.keys()))
+    ap.add_argument("--repeat", type=int, default=3, help="Take the best wall time of this many runs, defaults to 3.")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--no-memory", action="store_true", default=False, help="Skip the (slower) peak memory runs.")
+    ap.add_argument("--output", help="Save the results to this json file.")
+    ap.add_argument("--baseline", help="Compare the results against those saved in this json file.")
+    ap.add_argument("--tolerance", type=float, default=1.25,
+        help="Report a regression when a measure exceeds the baseline by this ratio, defaults to 1.25.")
+    ap.add_argument("--min-seconds", type=float, default=0.01,
+        help="Don't compare wall times shorter than this (too noisy), defaults to 0.01.")
+    aargs = ap.parse_args(argv)
+
+    if aargs.width < 4:
+        ap.error("The width must be at least 4.")
+
+    results = {}
+
+    for rows in aargs.rows:
+        header, data = generate(rows, aargs.width, aargs.seed)
+
+        for operation in aargs.operations:
+            measure = benchmark(OPERATIONS[operation], header, data, aargs.repeat, not aargs.no_memory)
+            results.setdefault(operation, {})[str(rows)] = measure
+            print("%-12s %10d rows %10.4fs %s" % (operation, rows, measure["seconds"],
+                "" if measure["peak_bytes"] is None else "%12d bytes" % measure["peak_bytes"]))
+            sys.stdout.flush()
+
+    if aargs.output is not None:
+        with open(aargs.output, "w") as fh:
+            json.dump({"width": aargs.width, "results": results}, fh, indent=2, sort_keys=True)
+
+    if aargs.baseline is not None:
+        with open(aargs.baseline, "r") as fh:
+            baseline = json.load(fh)["results"]
+
+        regressions = compare(results, baseline, aargs.tolerance, aargs.min_seconds)
+        return 0 if regressions == 0 else 1
+
+    return 0
+
+
+def generate(rows, width, seed):
+    # Columns: a unique int id, a low cardinality int, a float, a low cardinality string, and then further ints.
+    generator = random.Random(seed)
+    header = ["id", "key", "value", "category"] + ["extra%d" % i for i in range(0, width - 4)]
+    data = []
+
+    for i in range(0, rows):
+        data += [[i, generator.randrange(JOIN_KEYS), generator.random(), "c%d" % generator.randrange(CATEGORIES)] \
+            + [generator.randrange(rows) for j in range(4, width)]]
+
+    return header, data
+
+
+def benchmark(operation, header, data, repeat, memory):
+    # The setup (not measured) produces the function to measure.
+    best = None
+
+    for r in range(0, repeat):
+        func = operation(header, data)
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    peak = None
+
+    if memory:
+        func = operation(header, data)
+        gc.collect()
+        tracemalloc.start()
+
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        "seconds": best,
+        "peak_bytes": peak,
+    }
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    regressions = 0
+
+    for operation, measures in sorted(results.items()):
+        for rows, measure in sorted(measures.items(), key=lambda item: int(item[0])):
+            if rows not in baseline.get(operation, {}):
+                continue
+
+            for key in ["seconds", "peak_bytes"]:
+                before = baseline[operation][rows][key]
+                after = measure[key]
+
+                if before is None or after is None or before == 0:
+                    continue
+
+                if key == "seconds" and max(before, after) < min_seconds:
+                    continue
+
+                ratio = after / before
+                regressed = ratio > tolerance
+                regressions += 1 if regressed else 0
+                print("%-12s %10s rows %-10s %6.2fx%s" % (operation, rows, key, ratio,
+                    " REGRESSION" if regressed else ""))
+
+    print("%d regression(s) beyond %.2fx." % (regressions, tolerance))
+    return regressions
+
+
+def _construct(header, data):
+    return lambda: Table(header, data)
+
+
+def _refine(header, data):
+    table = Table(header, data)
+    return lambda: table.refine("key", lambda value: value < JOIN_KEYS / 2)
+
+
+def _convert(header, data):
+    table = Table(header, data)
+    return lambda: table.convert("value", lambda value: value * 2)
+
+
+def _extend(header, data):
+    table = Table(header, data)
+    return lambda: table.extend(["key", "value"], lambda key, value: key + value, "sum")
+
+
+def _join(header, data):
+    table = Table(header, data)
+    other = Table(["key", "name"], [[key, "k%d" % key] for key in range(0, JOIN_KEYS)])
+    return lambda: table.join("key", other, "key")
+
+
+def _sort(header, data):
+    table = Table(header, data)
+    return lambda: table.sort(["category", "value"])
+
+
+def _unique(header, data):
+    table = Table(header, data)
+    return lambda: table.rows(["key", "category"], unique=True)
+
+
+def _lazy(header, data):
+    table = Table(header, data)
+    return lambda: table.lazy() \
+        .convert("value", lambda value: value * 2) \
+        .extend(["key", "value"], lambda key, value: key + value, "sum") \
+        .refine("sum", lambda value: value < JOIN_KEYS / 2) \
+        .narrow(["id", "sum", "category"]) \
+        .sort("sum") \
+        .collect()
+
+
+def _load_csv(header, data):
+    csv = "\n".join([",".join(header)] + [",".join([str(value) for value in row]) for row in data])
+    return lambda: Table.load_csv(csv, infer_types=True)
+
+
+OPERATIONS = {
+    "construct": _construct,
+    "refine": _refine,
+    "convert": _convert,
+    "extend": _extend,
+    "join": _join,
+    "sort": _sort,
+    "unique": _unique,
+    "lazy": _lazy,
+    "load_csv": _load_csv,
+}
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
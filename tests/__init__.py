@@ -1,6 +1,6 @@
 
 from pytils.invigilator import create_suite
-from tests import adjutant, base, check, stream, table
+from tests import adjutant, base, check, pickler, stream, table
 
 
 def all():
@@ -12,6 +12,7 @@ def unit():
         adjutant.tests(),
         base.tests(),
         check.tests(),
+        pickler.tests(),
         stream.tests(),
         table.tests(),
     ]
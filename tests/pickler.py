@@ -0,0 +1,270 @@
+import mmap
+import os
+import pickle
+import queue
+from tempfile import TemporaryDirectory
+import threading
+import time
+import tracemalloc
+from unittest import TestCase, skipIf
+
+from pytils import pickler
+from pytils.invigilator import create_suite
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Tests(TestCase):
+    def setUp(self):
+        self.target_file_size = pickler.TARGET_FILE_SIZE
+
+    def tearDown(self):
+        pickler.TARGET_FILE_SIZE = self.target_file_size
+
+    def test_save_load(self):
+        with TemporaryDirectory() as temp_dir:
+            for offsets in [False, True]:
+                for data in [[], [1], [{"i": i, "s": str(i)} for i in range(0, 100)]]:
+                    dir_path = os.path.join(temp_dir, "%s-%d" % (offsets, len(data)))
+                    pickler.save(data, dir_path, offsets=offsets)
+                    self.assertEqual(list(pickler.load(dir_path)), data)
+                    self.assertEqual(pickler.length(dir_path), len(data))
+
+            dir_path = os.path.join(temp_dir, "converted")
+            pickler.save([i for i in range(0, 10)], dir_path, converter=lambda i: i * 2)
+            self.assertEqual(list(pickler.load(dir_path, converter=lambda i: None if i % 4 == 0 else i)), [2, 6, 10, 14, 18])
+
+            dir_path = os.path.join(temp_dir, "empty")
+            os.makedirs(dir_path)
+            open(os.path.join(dir_path, "0" + pickler.EXTENSION), "wb").close()
+
+            with self.assertRaises(EOFError):
+                list(pickler.load(dir_path))
+
+        self.assertEqual(list(pickler.load(os.path.join(temp_dir, "missing"), allow_not_found=True)), [])
+        self.assertEqual(pickler.length(os.path.join(temp_dir, "missing"), allow_not_found=True), None)
+
+    def test_save_stream(self):
+        with TemporaryDirectory() as temp_dir:
+            data = queue.Queue()
+            pickler.save(data, temp_dir, offsets=True)
+
+            for i in range(0, 50):
+                data.put(i)
+
+            data.put(None)
+
+            _join_writers()
+
+            self.assertEqual(list(pickler.load(temp_dir)), [i for i in range(0, 50)])
+            self.assertEqual(pickler.get(temp_dir, 42), 42)
+
+    def test_get_slice(self):
+        data = [str(i) for i in range(0, 1000)]
+
+        # Spread the data across a number of shards.
+        pickler.TARGET_FILE_SIZE = 1000
+
+        with TemporaryDirectory() as temp_dir:
+            for offsets in [False, True]:
+                dir_path = os.path.join(temp_dir, str(offsets))
+                pickler.save(data, dir_path, offsets=offsets)
+                self.assertTrue(len(pickler._read_manifest(dir_path)["counts"]) > 1)
+
+                for i in [0, 1, 99, 500, 999, -1, -1000]:
+                    self.assertEqual(pickler.get(dir_path, i), data[i])
+
+                for i in [1000, -1001]:
+                    with self.assertRaises(IndexError):
+                        pickler.get(dir_path, i)
+
+                for start, stop in [(None, None), (0, 10), (95, 405), (990, 2000), (500, 400), (None, -3), (-7, None)]:
+                    self.assertEqual(list(pickler.load(dir_path, start=start, stop=stop)), data[start:stop])
+
+                # Directories from before the manifest are still readable.
+                os.remove(os.path.join(dir_path, pickler.MANIFEST_FILE))
+
+                if not offsets:
+                    self.assertEqual(list(pickler.load(dir_path)), data)
+                    self.assertEqual(list(pickler.load(dir_path, start=95, stop=405)), data[95:405])
+                    self.assertEqual(list(pickler.load(dir_path, start=-3)), data[-3:])
+                    self.assertEqual(list(pickler.load(dir_path, start=-500, stop=-495)), data[-500:-495])
+                    self.assertEqual(pickler.get(dir_path, -2), data[-2])
+
+    def test_load_offsets_streams(self):
+        data = [[i, "x" * 1000] for i in range(0, 1000)]
+
+        with TemporaryDirectory() as temp_dir:
+            for codec in [None, "zlib"]:
+                dir_path = os.path.join(temp_dir, str(codec))
+                pickler.save(data, dir_path, offsets=True, codec=codec)
+                tracemalloc.start()
+
+                try:
+                    for item in pickler.load(dir_path, start=500):
+                        pass
+
+                    peak = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+
+                # Only about an item at a time is held, rather than the whole (~1 MB decompressed) shard.
+                self.assertLess(peak, 100 * 1024)
+
+    def test_load_workers(self):
+        data = [str(i) for i in range(0, 1000)]
+        pickler.TARGET_FILE_SIZE = 1000
+
+        with TemporaryDirectory() as temp_dir:
+            for offsets in [False, True]:
+                dir_path = os.path.join(temp_dir, str(offsets))
+                pickler.save(data, dir_path, offsets=offsets)
+
+                for workers, prefetch in [(1, None), (2, None), (3, 1), (2, 5)]:
+                    self.assertEqual(list(pickler.load(dir_path, workers=workers, prefetch=prefetch)), data)
+                    self.assertEqual(list(pickler.load(dir_path, start=95, stop=405, workers=workers,
+                        prefetch=prefetch)), data[95:405])
+                    # The (unpicklable) converter runs in the workers.
+                    self.assertEqual(list(pickler.load(dir_path, workers=workers, prefetch=prefetch,
+                        converter=lambda item: None if int(item) % 2 == 0 else int(item))), [int(i) for i in data[1::2]])
+
+                loader = pickler.load(dir_path, workers=2)
+                self.assertEqual(next(loader), data[0])
+                loader.close()
+
+                with self.assertRaises(ValueError):
+                    list(pickler.load(dir_path, workers=0))
+
+                with self.assertRaises(ZeroDivisionError):
+                    list(pickler.load(dir_path, workers=2, converter=lambda item: 1 / 0))
+
+    def test_load_workers_parent_time(self):
+        data = [{"i": i, "s": "item %d" % i} for i in range(0, 20000)]
+        converter = lambda item: sum(range(0, 1000)) and item["i"]
+
+        with TemporaryDirectory() as temp_dir:
+            for codec in [None, "zlib"]:
+                dir_path = os.path.join(temp_dir, str(codec))
+                pickler.save(data, dir_path, codec=codec)
+                seconds = {}
+
+                for workers in [None, 2]:
+                    # The time spent in this process alone (not the workers), whichever the number of cpus.
+                    start = time.process_time()
+                    self.assertEqual(list(pickler.load(dir_path, converter=converter, workers=workers)),
+                        [i for i in range(0, 20000)])
+                    seconds[workers] = time.process_time() - start
+
+                # The converter runs in the workers, which leaves just its results to be unpickled here.
+                self.assertLess(seconds[2], seconds[None] / 2)
+
+    def test_codecs(self):
+        data = ["item %d " % i * 20 for i in range(0, 1000)]
+        pickler.TARGET_FILE_SIZE = 20000
+
+        with TemporaryDirectory() as temp_dir:
+            plain_path = os.path.join(temp_dir, "plain")
+            pickler.save(data, plain_path)
+            plain_shards = len(pickler._read_manifest(plain_path)["counts"])
+
+            for codec in sorted(pickler.CODECS.keys()):
+                for offsets in [False, True]:
+                    for workers in [None, 3]:
+                        dir_path = os.path.join(temp_dir, "%s-%s-%s" % (codec, offsets, workers))
+                        pickler.save(data, dir_path, offsets=offsets, codec=codec, workers=workers)
+                        manifest = pickler._read_manifest(dir_path)
+                        self.assertEqual(manifest["codec"], codec)
+                        # The shards are batched by their compressed size.
+                        self.assertTrue(len(manifest["counts"]) < plain_shards)
+                        self.assertEqual(list(pickler.load(dir_path)), data)
+                        self.assertEqual(list(pickler.load(dir_path, workers=2)), data)
+                        self.assertEqual(list(pickler.load(dir_path, start=95, stop=405)), data[95:405])
+                        self.assertEqual(pickler.get(dir_path, 777), data[777])
+
+                with open(os.path.join(temp_dir, "%s-False-None" % codec, "0" + pickler.EXTENSION), "rb") as fh:
+                    self.assertNotEqual(fh.read(1), b"\x80")
+
+            with self.assertRaises(ValueError):
+                pickler.save(data, os.path.join(temp_dir, "unknown"), codec="unknown")
+
+            data = queue.Queue()
+            stream_path = os.path.join(temp_dir, "stream")
+            pickler.save(data, stream_path, codec="zlib")
+
+            for i in range(0, 50):
+                data.put(i)
+
+            data.put(None)
+
+            _join_writers()
+
+            self.assertEqual(list(pickler.load(stream_path)), [i for i in range(0, 50)])
+
+    def test_out_of_band(self):
+        size = pickler.OUT_OF_BAND_BYTES
+        data = [{
+            "i": i,
+            "blob": pickle.PickleBuffer(bytes([i]) * (size + i)),
+            "small": pickle.PickleBuffer(bytes([i])),
+        } for i in range(0, 10)]
+
+        with TemporaryDirectory() as temp_dir:
+            for offsets in [False, True]:
+                for codec in [None, "zlib"]:
+                    dir_path = os.path.join(temp_dir, "%s-%s" % (offsets, codec))
+                    pickler.save(data, dir_path, offsets=offsets, codec=codec, out_of_band=True)
+                    positions = pickler._read_array(os.path.join(dir_path, "0" + pickler.BUFFER_OFFSETS_EXTENSION), 0)
+                    self.assertEqual(len(positions), 20)
+                    self.assertTrue(all([position % pickler.BUFFER_ALIGNMENT == 0 for position in positions[::2]]))
+
+                    for start, stop, workers in [(None, None, None), (3, 7, None), (9, None, None), (3, 7, 2)]:
+                        # Without a converter, the items (and their buffers) are decoded here, even with workers.
+                        loaded = list(pickler.load(dir_path, start=start, stop=stop, workers=workers))
+                        self.assertEqual([item["i"] for item in loaded], [i for i in range(0, 10)][start:stop])
+
+                        for item in loaded:
+                            # The large buffers are views over the memory map; the small ones are in band.
+                            self.assertIsInstance(item["blob"].obj, mmap.mmap)
+                            self.assertEqual(bytes(item["blob"]), bytes([item["i"]]) * (size + item["i"]))
+                            self.assertEqual(item["small"], bytes([item["i"]]))
+
+                    self.assertEqual(pickler.get(dir_path, 4)["i"], 4)
+                    # Converted in the workers, the buffers come back as copies.
+                    converted = list(pickler.load(dir_path, start=2, workers=2, converter=lambda item: item))
+                    self.assertEqual([item["i"] for item in converted], [i for i in range(2, 10)])
+                    self.assertEqual([bytes(item["blob"]) for item in converted],
+                        [bytes([i]) * (size + i) for i in range(2, 10)])
+
+            dir_path = os.path.join(temp_dir, "empty")
+            pickler.save([], dir_path, out_of_band=True)
+            self.assertEqual(list(pickler.load(dir_path)), [])
+
+    @skipIf(numpy is None, "requires numpy")
+    def test_out_of_band_numpy(self):
+        data = [numpy.arange(i, i + 100000, dtype=numpy.float64) for i in range(0, 5)] + [numpy.arange(0, 10)]
+
+        with TemporaryDirectory() as temp_dir:
+            pickler.save(data, temp_dir, out_of_band=True)
+            loaded = list(pickler.load(temp_dir))
+            self.assertTrue(all([(a == b).all() for a, b in zip(data, loaded)]))
+            # Views over the (read only) memory map, rather than copies.
+            self.assertFalse(loaded[0].flags.owndata)
+            self.assertFalse(loaded[0].flags.writeable)
+            self.assertTrue(loaded[-1].flags.writeable)
+            self.assertTrue(all([(a == b).all() for a, b in zip(data, pickler.load(temp_dir, workers=2))]))
+            converted = pickler.load(temp_dir, workers=2, converter=lambda item: item * 2)
+            self.assertTrue(all([(a * 2 == b).all() for a, b in zip(data, converted)]))
+
+
+def _join_writers():
+    # Streamed saves write from (non-daemon) threads, which are done once they've seen the end of the stream.
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join()
+
+
+def tests():
+    return create_suite(Tests)
@@ -1,6 +1,18 @@
-from unittest import TestCase
-
-from pytils.table import Table, INDEXING
+import bz2
+from collections import Counter
+from datetime import date
+from functools import reduce
+import gzip
+import math
+from operator import mul
+import os
+import pickle
+from tempfile import TemporaryDirectory
+import tracemalloc
+from unittest import TestCase, skipIf
+
+from pytils.table import Table, TableBuilder, Aggregation, Reducer, Vectorized, numpy, INDEXING, INNER, LEFT, OUTER, RIGHT, HASH, SORTED, \
+    CHUNK_ROWS, SUM, COUNT, MEAN, MIN, MAX, FIRST, LAST
 from pytils.invigilator import create_suite
 
 
@@ -57,6 +69,27 @@ class Tests(TestCase):
         self.assertEqual(table.draw([]),
             "")
 
+    def test_table_storage(self):
+        table = Table(["i", "f", "s", "m"], [[1, 1.5, "a", 1], [2, 2.5, "b", "2"], [2**70, 3.5, "c", None]])
+        self.assertEqual(table.column("i"), [1, 2, 2**70])
+        self.assertEqual(table.column("f"), [1.5, 2.5, 3.5])
+        self.assertEqual(table.column("s"), ["a", "b", "c"])
+        self.assertEqual(table.column("m"), [1, "2", None])
+        self.assertEqual(Table(["a", "b"], ([i, str(i)] for i in range(0, 3))).rows(), [[0, "0"], [1, "1"], [2, "2"]])
+        self.assertEqual(Table(["a"], iter([])).rows(), [])
+        self.assertEqual(table.rows(limit=1), [[1, 1.5, "a", 1]])
+        # Make sure the column is immutable
+        c = table.column("f")
+        c[0] = 0.0
+        self.assertEqual(table.column("f"), [1.5, 2.5, 3.5])
+
+        table = Table(["i", "f"], [[1, 1.5], [2, 2.5]])
+        self.assertEqual(table.column("i"), [1, 2])
+        self.assertEqual(table.column("f", 1), [1.5])
+        self.assertEqual(table, Table.load_csv("i,f\n1,1.5\n2,2.5", {"i": int, "f": float}))
+        self.assertEqual(Table(["col"], [[1]]), Table(["col"], [[1.0]]))
+        self.assertNotEqual(Table(["col"], [[1]]), Table(["col"], [[1], [2]]))
+
     def test_table_refine(self):
         table = Table.load_csv("col1,col2,col3\n1,2,3\n4,5,6")
         expected = Table.load_csv("col1,col2,col3\n1,2,3")
@@ -73,6 +106,60 @@ class Tests(TestCase):
         refined = table.refine(refinements={"col1": "1"})
         self.assertEqual(refined, expected)
 
+    def test_table_refine_ordering(self):
+        table = Table(["a", "b", "c"], [[i, i % 2, str(i % 3)] for i in range(0, 1000)])
+        calls = {"rare": 0, "common": 0}
+
+        def rare(v):
+            calls["rare"] += 1
+            return v < 10
+
+        def common(v):
+            calls["common"] += 1
+            return v == 0
+
+        refined = table.refine(refinements={"b": common, "a": rare, "c": "0"})
+        self.assertEqual(refined.column("a"), [0, 6])
+        # The equality test runs first, and then the most selective function.
+        self.assertEqual(calls["rare"], 100 + 334)
+        self.assertEqual(calls["common"], 100 + 4)
+
+        calls = {"rare": 0, "common": 0}
+        refined = table.refine(refinements={"b": common, "a": rare}, selectivity={"a": 0.9, "b": 0.1})
+        self.assertEqual(refined.column("a"), [0, 2, 4, 6, 8])
+        self.assertEqual(calls["common"], 1000)
+        self.assertEqual(calls["rare"], 500)
+
+        # Tests need not produce a bool.
+        self.assertEqual(table.refine("c", lambda v: int(v)).height(), 666)
+
+    def test_table_index(self):
+        table = Table.load_csv("col1,col2,col3\n1,2,3\n4,5,6\n1,5,9\n7,8,9", {"col3": int})
+        unindexed = Table.load_csv("col1,col2,col3\n1,2,3\n4,5,6\n1,5,9\n7,8,9", {"col3": int})
+        self.assertIs(table.create_index("col1"), table)
+        table.create_index("col3", SORTED)
+
+        for refinements in [{"col1": "1"}, {"col1": "1", "col2": "5"}, {"col1": "x"}, {"col3": 9},
+                            {"col3": 9, "col1": lambda v: v > "1"}, {"col2": "5"}]:
+            self.assertEqual(table.refine(refinements=refinements), unindexed.refine(refinements=refinements))
+
+        self.assertEqual(table.refine("col1", "1").rows(), [["1", "2", 3], ["1", "5", 9]])
+
+        for lower, upper in [(None, None), (4, 9), (4, None), (None, 5), (7, 3), (10, 11)]:
+            self.assertEqual(table.between("col3", lower, upper), unindexed.between("col3", lower, upper))
+
+        self.assertEqual(table.between("col3", 4, 9).column("col1"), ["4", "1", "7"])
+
+        with self.assertRaises(ValueError):
+            table.create_index("col1", "trie")
+
+        # Values which can't be looked up in the index are still just checked row by row.
+        for kind in [HASH, SORTED]:
+            table = Table(["a"], [[1], [2], [3]]).create_index("a", kind)
+            self.assertEqual(table.refine("a", "2").rows(), [])
+            self.assertEqual(table.refine("a", [1]).rows(), [])
+            self.assertEqual(table.refine("a", 2).rows(), [[2]])
+
     def test_table_convert(self):
         table = Table.load_csv("col1,col2,col3\n1,2,3\n4,5,6")
 
@@ -126,6 +213,71 @@ class Tests(TestCase):
             ["4", "5", "6", -1, 4, "546", "abc"]
         ])
 
+    def test_table_vectorized(self):
+        table = Table(["i", "f", "s"], [[1, 0.5, "a"], [2, 1.5, "b"], [3, 2.5, "c"]])
+        positive = Vectorized(lambda c: c > 1.0, lambda v: v > 1.0)
+        double = Vectorized(lambda c: c * 2, lambda v: v * 2)
+        add = Vectorized(lambda a, b: a + b, lambda a, b: a + b)
+
+        self.assertEqual(table.refine("f", positive).column("s"), ["b", "c"])
+        self.assertEqual(table.refine(refinements={"f": positive, "s": "c"}).column("i"), [3])
+        self.assertEqual(table.refine(refinements={"f": positive, "i": lambda v: v < 3}).column("s"), ["b"])
+        self.assertEqual(table.create_index("s").refine(refinements={"f": positive, "s": "a"}).rows(), [])
+        self.assertEqual(table.convert("i", double).column("i"), [2, 4, 6])
+        self.assertEqual(table.convert("f", double).column("f"), [1.0, 3.0, 5.0])
+        self.assertEqual(table.extend(["i", "f"], add, "sum").column("sum"), [1.5, 3.5, 5.5])
+        self.assertEqual(table.lazy().refine("f", positive).convert("i", double).rows(), [[4, 1.5, "b"], [6, 2.5, "c"]])
+        self.assertEqual(Table(["i"], []).refine("i", positive).convert("i", double).rows(), [])
+
+    @skipIf(numpy is None, "requires NumPy")
+    def test_table_vectorized_numpy(self):
+        table = Table(["i", "f", "s"], [[1, 0.5, "a"], [2, 1.5, "b"], [3, 2.5, "c"]])
+
+        self.assertEqual(table.refine("f", Vectorized(lambda c: c > 1.0)).column("s"), ["b", "c"])
+        self.assertEqual(table.refine("s", Vectorized(lambda c: c != "b")).column("s"), ["a", "c"])
+        self.assertEqual(table.convert("f", numpy.floor).column("f"), [0.0, 1.0, 2.0])
+        self.assertEqual(table.convert("i", Vectorized(lambda c: c % 2 == 0)).column("i"), [False, True, False])
+        self.assertEqual(table.extend(["i"], Vectorized(numpy.cumsum), "total").column("total"), [1, 3, 6])
+        self.assertEqual(table.extend([], Vectorized(lambda: 7), "seven").column("seven"), [7, 7, 7])
+
+        # The column buffers are never writable.
+        with self.assertRaises(ValueError):
+            table.convert("i", Vectorized(lambda c: c.fill(0)))
+
+        self.assertEqual(table.column("i"), [1, 2, 3])
+
+        # Typed columns of any (numeric) typecode.
+        built = TableBuilder(["f", "i", "b"], {"f": "f", "i": "i", "b": "B"}).extend([[1.5, 1, 1], [3.0, -2, 2]]).build()
+        self.assertEqual(built.refine("f", Vectorized(lambda c: c > 2.0)).column("f"), [3.0])
+        self.assertEqual(built.convert("i", Vectorized(lambda c: c * 2)).column("i"), [2, -4])
+        self.assertEqual(built.extend(["b", "i"], Vectorized(lambda b, i: b + i), "sum").column("sum"), [2, 0])
+
+        # Lazily, the columns are just as typed.
+        pipeline = lambda t: t.convert("i", lambda v: v + 1).refine("i", lambda v: v > 2).convert("f", numpy.sqrt)
+        lazy = pipeline(table.lazy()).collect()
+        self.assertEqual(lazy, pipeline(table))
+        self.assertEqual(lazy._columns[1].typecode, "d")
+
+    def test_table_workers(self):
+        table = Table(["i", "s"], [[i, str(i)] for i in range(0, 103)])
+        conversions = {"i": lambda v: v * 2, "s": lambda v: v + "!"}
+        extensions = [
+            {"names": ["i", "s"], "func": lambda i, s: s * i, "target": "repeated"},
+            {"names": [], "func": lambda: 1, "target": "one"}
+        ]
+
+        for workers in [2, 3]:
+            self.assertEqual(table.convert(conversions=conversions, workers=workers), table.convert(conversions=conversions))
+            self.assertEqual(table.extend(extensions=extensions, workers=workers), table.extend(extensions=extensions))
+
+        self.assertEqual(Table(["i"], []).convert("i", lambda v: v, workers=2).rows(), [])
+
+        with self.assertRaises(ZeroDivisionError):
+            table.convert("i", lambda v: 1 / v, workers=2)
+
+        with self.assertRaises(ValueError):
+            table.convert("i", lambda v: v, workers=0)
+
     def test_table_narrow(self):
         table = Table.load_csv("col1,col2,col3\n1,2,3\n4,5,6\n4,5,7")
         self.assertEqual(table.narrow(["col1", "col2"]).rows(), [["1", "2"], ["4", "5"], ["4", "5"]])
@@ -136,6 +288,18 @@ class Tests(TestCase):
 
         self.assertEqual(table.narrow(["col1", "col2"]).rows(), [["1", "2"], ["4", "5"], ["4", "5"]])
 
+    def test_table_distinct(self):
+        table = Table.load_csv("col1,col2,col3\n4,5,6\n1,2,3\n4,5,7\n1,2,8")
+        self.assertEqual(table.rows(["col1", "col2"], unique=True), [["4", "5"], ["1", "2"]])
+        self.assertEqual(table.rows(["col1", "col2"], limit=1, unique=True), [["4", "5"]])
+        self.assertEqual(list(table.distinct(["col2", "col1"]).items()), [(("5", "4"), 2), (("2", "1"), 2)])
+        self.assertEqual(len(table.distinct(["col3"])), 4)
+        self.assertEqual(table.distinct([]), {})
+
+        table = Table(["col1", "col2"], [[[1], 2], [[1], 2], [[2], 2]])
+        self.assertEqual(table.rows(unique=True), [[[1], 2], [[2], 2]])
+        self.assertEqual(table.narrow(["col1"], unique=True).rows(), [[[1]], [[2]]])
+
     def test_table_drop(self):
         table = Table.load_csv("col1,col2,col3\n1,2,3\n4,5,6\n4,5,7")
         self.assertEqual(table.drop(["col3"]).rows(), [["1", "2"], ["4", "5"], ["4", "5"]])
@@ -158,6 +322,180 @@ class Tests(TestCase):
             ["1", "alice", "1", "virtuous"]
         ])
 
+    def test_table_join_outer(self):
+        table_a = Table.load_csv("id,name\n1,alice\n2,bob\n3,eve")
+        table_b = Table.load_csv("fid,spirit\n1,virtuous\n1,delightful\n3,evil\n0,moot")
+
+        joined = table_a.join("id", table_b, "fid", how=LEFT)
+        self.assertEqual(joined.sort("id").rows(), [
+            ["1", "alice", "1", "virtuous"],
+            ["1", "alice", "1", "delightful"],
+            ["2", "bob", None, None],
+            ["3", "eve", "3", "evil"]
+        ])
+
+        joined = table_a.join("id", table_b, "fid", how=RIGHT)
+        self.assertEqual(joined.sort("spirit").rows(), [
+            ["1", "alice", "1", "delightful"],
+            ["3", "eve", "3", "evil"],
+            [None, None, "0", "moot"],
+            ["1", "alice", "1", "virtuous"]
+        ])
+
+        joined = table_a.join("id", table_b, "fid", how=OUTER)
+        self.assertEqual(joined.height(), 5)
+        self.assertEqual(joined.refine("name", "bob").rows(), [["2", "bob", None, None]])
+        self.assertEqual(joined.refine("spirit", "moot").rows(), [[None, None, "0", "moot"]])
+
+        # The larger table on the left hand side.
+        joined = table_b.join("fid", table_a, "id", how=LEFT)
+        self.assertEqual(joined.sort("spirit").rows(), [
+            ["1", "delightful", "1", "alice"],
+            ["3", "evil", "3", "eve"],
+            ["0", "moot", None, None],
+            ["1", "virtuous", "1", "alice"]
+        ])
+
+        # The rows follow this table's order, whichever table is larger (and so is hashed).
+        for table_c in [Table.load_csv("fid,spirit\n3,evil\n1,virtuous"), table_b.merge(table_b.refine("fid", "3"))]:
+            for how in [INNER, LEFT, RIGHT, OUTER]:
+                joined = table_a.join("id", table_c, "fid", how=how)
+                ids = [value for value in joined.column("id") if value is not None]
+                self.assertEqual(ids, sorted(ids))
+                self.assertEqual(joined.column("id")[len(ids):], [None] * (joined.height() - len(ids)))
+
+        joined = table_a.join("id", table_b.merge(table_b), "fid", how=OUTER)
+        self.assertEqual(joined.column("spirit"), ["virtuous", "delightful", "virtuous", "delightful", None, "evil",
+            "evil", "moot", "moot"])
+
+        with self.assertRaises(ValueError):
+            table_a.join("id", table_b, "fid", how="sideways")
+
+    def test_table_join_multiple(self):
+        table_a = Table.load_csv("id,kind,name\n1,a,alice\n1,b,bob\n2,a,eve")
+        table_b = Table.load_csv("id,kind,name\n1,b,robert\n2,b,eva\n2,a,evelyn")
+        joined = table_a.join(["id", "kind"], table_b, ["id", "kind"])
+
+        self.assertEqual(joined.header(), ["id_0", "kind_0", "name_0", "id_1", "kind_1", "name_1"])
+        self.assertEqual(joined.sort("name_0").rows(), [
+            ["1", "b", "bob", "1", "b", "robert"],
+            ["2", "a", "eve", "2", "a", "evelyn"]
+        ])
+
+        joined = table_a.join(["id", "kind"], table_b, ["id", "kind"], suffixes=("", "_other"))
+        self.assertEqual(joined.header(), ["id", "kind", "name", "id_other", "kind_other", "name_other"])
+
+        with self.assertRaises(ValueError):
+            table_a.join(["id", "kind"], table_b, ["id"])
+
+    def test_table_describe(self):
+        table = Table(["i", "f", "s", "m", "e"], [
+            [1, 1.0, "b", 1, None],
+            [2, 3.0, "a", None, None],
+            [3, 3.0, "a", "x", None],
+            [4, 5.0, "c", [1], None]
+        ])
+        described = table.describe()
+        self.assertEqual(described.header(), ["name", "count", "nulls", "distinct", "min", "max", "mean", "stddev",
+            "q1", "q2", "q3"])
+        self.assertEqual(described.rows(), [
+            ["i", 4, 0, 4, 1, 4, 2.5, math.sqrt(1.25), 2, 3, 4],
+            ["f", 4, 0, 3, 1.0, 5.0, 3.0, math.sqrt(2.0), 3.0, 3.0, 5.0],
+            ["s", 4, 0, 3, "a", "c", None, None, "a", "b", "c"],
+            ["m", 3, 1, 3, None, None, None, None, None, None, None],
+            ["e", 0, 4, 0, None, None, None, None, None, None, None]
+        ])
+        self.assertEqual(table.describe(["s", "i"]).column("name"), ["s", "i"])
+        self.assertEqual(table.describe(["s"]).rows(), described.refine("name", "s").rows())
+        self.assertEqual(Table(["i"], []).describe().rows(), [["i", 0, 0, 0, None, None, None, None, None, None, None]])
+        self.assertEqual(table.categorize(["s"]).describe(["s"]), table.describe(["s"]))
+
+        # Values with a large offset keep their precision, both as typed and as list columns.
+        for values in [[1e9 + 1, 1e9 + 2, 1e9 + 3], [10**9 + 1, 10**9 + 2, 10**9 + 3], [1e8 + 0.1, 1e8 + 0.2, None, 1e8 + 0.3]]:
+            description = Table(["v"], [[value] for value in values]).describe()
+            self.assertAlmostEqual(description.column("stddev")[0] / (values[1] - values[0]), math.sqrt(2.0 / 3.0), places=6)
+
+        table = Table(["i"], [[i] for i in range(0, 10001)])
+        self.assertEqual(table.describe().rows()[0][:6], ["i", 10001, 0, 10001, 0, 10000])
+        self.assertTrue(abs(table.describe().column("q2")[0] - 5000) < 500)
+
+    def test_table_group_by(self):
+        table = Table.load_csv("key,kind,value\na,x,1\nb,x,2\na,y,3\na,x,4\nc,y,5", {"value": int})
+        grouped = table.group_by(["key"]).aggregate({
+            "sum": ("value", SUM),
+            "count": ("value", COUNT),
+            "mean": ("value", MEAN),
+            "min": ("value", MIN),
+            "max": ("value", MAX),
+            "first": ("kind", FIRST),
+            "last": ("kind", LAST),
+            "kinds": ("kind", lambda values: "".join(sorted(values))),
+            "product": ("value", Reducer(lambda values: reduce(mul, values), mul)),
+        })
+        self.assertEqual(grouped.header(),
+            ["key", "sum", "count", "mean", "min", "max", "first", "last", "kinds", "product"])
+        self.assertEqual(grouped.rows(), [
+            ["a", 8, 3, 8 / 3.0, 1, 4, "x", "x", "xxy", 12],
+            ["b", 2, 1, 2.0, 2, 2, "x", "x", "x", 2],
+            ["c", 5, 1, 5.0, 5, 5, "y", "y", "y", 5]
+        ])
+
+        grouped = table.group_by(["kind", "key"]).aggregate({"total": ("value", SUM)})
+        self.assertEqual(grouped.rows(), [["x", "a", 5], ["x", "b", 2], ["y", "a", 3], ["y", "c", 5]])
+
+        # Aggregating in chunks gives the same result.
+        aggregation = Aggregation(["key"], {"sum": ("value", SUM), "mean": ("value", MEAN), "first": ("kind", FIRST),
+            "last": ("kind", LAST), "kinds": ("kind", lambda values: "".join(values))})
+
+        for chunk in [table.top(2), table.bottom(3)]:
+            aggregation.update(chunk)
+
+        self.assertEqual(aggregation.result().rows(), [
+            ["a", 8, 8 / 3.0, "x", "x", "xyx"],
+            ["b", 2, 2.0, "x", "x", "x"],
+            ["c", 5, 5.0, "y", "y", "y"]
+        ])
+
+        with self.assertRaises(ValueError):
+            table.group_by(["key"]).aggregate({"median": ("value", "median")})
+
+    def test_table_categorize(self):
+        table = Table.load_csv("id,country,status\n1,ca,on\n2,us,off\n3,ca,off\n4,mx,on\n5,ca,on", {"id": int})
+        categorized = table.categorize(["country", "status"])
+        self.assertEqual(categorized, table)
+        self.assertEqual(categorized.column("country"), ["ca", "us", "ca", "mx", "ca"])
+
+        self.assertEqual(categorized.refine("country", "ca"), table.refine("country", "ca"))
+        self.assertEqual(categorized.refine(refinements={"country": "ca", "status": "on"}),
+            table.refine(refinements={"country": "ca", "status": "on"}))
+        self.assertEqual(categorized.refine("country", "uk").rows(), [])
+        self.assertEqual(categorized.sort("country"), table.sort("country"))
+        self.assertEqual(categorized.sort("status", reverse=True), table.sort("status", reverse=True))
+        self.assertEqual(categorized.top_by("country", 2), table.top_by("country", 2))
+        self.assertEqual(categorized.bottom(3).refine("status", "on"), table.bottom(3).refine("status", "on"))
+        self.assertEqual(categorized.group_by(["country"]).aggregate({"ids": ("id", SUM)}),
+            table.group_by(["country"]).aggregate({"ids": ("id", SUM)}))
+
+        self.assertEqual(categorized.refine("country", ["ca"]).rows(), [])
+        self.assertEqual(Table(["a"], [[1], [None], [1]]).categorize(["a"]).rows(), [[1], [None], [1]])
+
+        # Equal values of different types would share a code, changing the data.
+        with self.assertRaises(ValueError):
+            Table(["a"], [[1], [1.0], [True]]).categorize(["a"])
+
+        names = Table.load_csv("code,name\nmx,mexico\nca,canada\nfr,france").categorize(["code"])
+
+        for how in [INNER, LEFT, RIGHT, OUTER]:
+            self.assertEqual(sorted(categorized.join("country", names, "code", how).rows(), key=str),
+                sorted(table.join("country", Table(names.header(), names.rows()), "code", how).rows(), key=str))
+
+        with TemporaryDirectory() as directory:
+            categorized.save(directory)
+            opened = Table.open(directory)
+            self.assertEqual(opened, table)
+            self.assertEqual(opened.refine("country", "ca"), table.refine("country", "ca"))
+            self.assertEqual(opened.top(2).materialize(), table.top(2))
+
     def test_table_merge(self):
         table_1 = Table.load_csv("col1,col2,col3\n1,2,3\n4,5,6",
             {"col1": lambda v: int(v)})
@@ -171,6 +509,39 @@ class Tests(TestCase):
             ["10", "11", "12"]
         ])
 
+    def test_table_views(self):
+        table_1 = Table(["i", "s"], [[i, str(i)] for i in range(0, 5)])
+        table_2 = Table(["i", "s"], [[i, str(i)] for i in range(5, 8)])
+        merged = table_1.merge(table_2).merge(table_1.top(2))
+        self.assertEqual(merged.column("i"), [0, 1, 2, 3, 4, 5, 6, 7, 0, 1])
+        self.assertEqual(merged.rows(limit=2), [[0, "0"], [1, "1"]])
+        self.assertEqual(merged.materialize(), merged)
+        self.assertEqual(merged.materialize().column("i"), merged.column("i"))
+
+        for view in [merged.bottom(7).top(5), merged.top(9).bottom(5).merge(table_2).bottom(6)]:
+            rows = view.rows()
+            self.assertEqual(view.height(), len(rows))
+            self.assertEqual(view.materialize().rows(), rows)
+            self.assertEqual(view.refine("i", lambda v: v > 2).rows(), [row for row in rows if row[0] > 2])
+            self.assertEqual(view.sort("s").rows(), sorted(rows, key=lambda row: row[1]))
+            self.assertEqual(view.top_by("i", 2).rows(), sorted(rows)[:2])
+            self.assertEqual(view.narrow(["s"]).column("s"), [row[1] for row in rows])
+            self.assertEqual(view.convert("i", lambda v: -v).column("i"), [-row[0] for row in rows])
+            self.assertEqual(view.join("i", table_2, "i").column("s_1"), [row[1] for row in rows if row[0] >= 5])
+
+        self.assertEqual(merged.bottom(3).top(1).column("s"), ["7"])
+
+        # Rows taken from merged typed columns stay typed.
+        floats = Table(["i", "f"], [[i, i / 2.0] for i in range(0, 5)])
+        floats = floats.merge(floats.bottom(3)).merge(floats)
+
+        for taken in [floats.refine("i", lambda v: v > 2), floats.sort("f"), floats.sort("i", reverse=True)]:
+            self.assertEqual([column.typecode for column in taken._columns], ["q", "d"])
+
+        self.assertEqual(floats.sort("f").column("i"), [0, 0, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4])
+        self.assertEqual(table_1.top(0).merge(table_2), table_2)
+        self.assertEqual(Table(["i"], []).merge(Table(["i"], [])).rows(), [])
+
     def test_table_top(self):
         table = Table.load_csv("col1,col2\n1,2\n3,4\n5,6")
         self.assertEqual(table.top(4).rows(), table.rows())
@@ -189,6 +560,16 @@ class Tests(TestCase):
         self.assertEqual(table.bottom(0).rows(), [])
         self.assertEqual(table.bottom(-1).rows(), [])
 
+    def test_table_top_by(self):
+        table = Table.load_csv("col1,col2\n1,5\n3,4\n5,6\n7,4\n9,1", {"col2": int})
+
+        for n in [-1, 0, 1, 2, 3, 5, 6]:
+            for reverse in [False, True]:
+                self.assertEqual(table.top_by("col2", n, reverse), table.sort("col2", reverse).top(n))
+
+        self.assertEqual(table.top_by("col2", 2).rows(), [["9", 1], ["3", 4]])
+        self.assertEqual(table.top_by("col2", 2, reverse=True).rows(), [["5", 6], ["1", 5]])
+
     def test_table_sort(self):
         table = Table.load_csv("col1,col2,col3\n1,2,3\n4,1,6")
 
@@ -228,6 +609,118 @@ class Tests(TestCase):
             ["0"]
         ])
 
+    def test_table_builder(self):
+        rows = [[i, float(i), str(i), None] for i in range(0, 10)]
+        builder = TableBuilder(["i", "f", "s", "n"], {"i": "q", "f": "d"})
+
+        for row in rows[:3]:
+            builder.append(row)
+
+        builder.extend(rows[3:8])
+        builder.extend(iter(rows[8:]))
+        builder.extend([])
+        self.assertEqual(builder.height(), 10)
+        table = builder.build()
+        self.assertEqual(table, Table(["i", "f", "s", "n"], rows))
+        self.assertEqual(builder.height(), 0)
+        self.assertEqual(builder.build().rows(), [])
+
+        with self.assertRaises(ValueError):
+            builder.append([1, 1.0, "1"])
+
+        with self.assertRaises(ValueError):
+            builder.extend([[1, 1.0, "1", None], [1, 1.0, "1"]])
+
+        with self.assertRaises(TypeError):
+            builder.append(["1", 1.0, "1", None])
+
+        with self.assertRaises(TypeError):
+            builder.extend([[1, 1.0, "1", None], [1, "1", "1", None]])
+
+        self.assertEqual(builder.append(rows[0]).build().rows(), rows[:1])
+        self.assertEqual(table.rows(), rows)
+
+    def test_table_sort_multiple(self):
+        rows = [[i % 3, i % 2, str(i)] for i in range(0, 12)]
+        table = Table(["a", "b", "c"], rows)
+        self.assertEqual(table.sort(["a", "b"]).rows(), sorted(rows, key=lambda row: (row[0], row[1])))
+        self.assertEqual(table.sort(["a", "b"], reverse=[False, True]).rows(),
+            sorted(rows, key=lambda row: (row[0], -row[1])))
+        self.assertEqual(table.sort(["b", "c"], reverse=True).rows(),
+            sorted(rows, key=lambda row: (row[1], row[2]), reverse=True))
+        self.assertEqual(table.categorize(["c"]).sort(["b", "c"], [True, False]).rows(),
+            sorted(rows, key=lambda row: (-row[1], row[2])))
+        self.assertEqual(table.lazy().sort(["a", "b"], [True, False]).narrow(["c"]).rows(),
+            table.sort(["a", "b"], [True, False]).narrow(["c"]).rows())
+
+        self.assertEqual(table.sort(name="a", reverse=True), table.sort("a", True))
+        self.assertEqual(table.sort(name=["a", "b"]), table.sort(["a", "b"]))
+        self.assertEqual(table.lazy().sort(name="a").collect(), table.sort("a"))
+
+        with self.assertRaises(ValueError):
+            table.sort(["a", "b"], [True])
+
+    def test_table_iter_sorted(self):
+        rows = [[(i * 7) % 11, i % 2, str(i)] for i in range(0, 50)]
+        tables = [Table(["a", "b", "c"], rows[i:i + 8]) for i in range(0, 50, 8)]
+
+        with TemporaryDirectory() as temp_dir:
+            for names, reverse, expected in [
+                ("a", False, sorted(rows, key=lambda row: row[0])),
+                (["b", "a"], [True, False], sorted(rows, key=lambda row: (-row[1], row[0]))),
+                (["b", "c"], True, sorted(rows, key=lambda row: (row[1], row[2]), reverse=True))
+            ]:
+                chunks = list(Table.iter_sorted(tables, names, reverse, spill_dir=temp_dir, chunk_rows=6))
+                self.assertEqual([chunk.height() for chunk in chunks], [6] * 8 + [2])
+                self.assertEqual([row for chunk in chunks for row in chunk.rows()], expected)
+                self.assertEqual(os.listdir(temp_dir), [])
+
+        # Only a row per run (plus an output chunk) is held while merging, rather than all of the rows.
+        tables = (Table(["k", "s"], [[(i * 7919) % 4000, "x" * 1000 + str(i)] for i in range(j, j + 100)]) \
+            for j in range(0, 4000, 100))
+        tracemalloc.start()
+
+        try:
+            keys = [key for chunk in Table.iter_sorted(tables, "k", chunk_rows=100) for key in chunk.column("k")]
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(keys, [i for i in range(0, 4000)])
+        self.assertLess(peak, 4000 * 1000 / 3)
+
+        self.assertEqual(list(Table.iter_sorted([], "a")), [])
+
+        with self.assertRaises(ValueError):
+            list(Table.iter_sorted([Table(["a"], [[1]]), Table(["b"], [[1]])], "a"))
+
+    def test_table_sample(self):
+        rows = [[i, i % 3] for i in range(0, 100)]
+        table = Table(["i", "g"], rows)
+        sample = table.sample(10, seed=1)
+        self.assertEqual(sample.height(), 10)
+        self.assertEqual(len(set(sample.column("i"))), 10)
+        self.assertTrue(all([rows[row[0]] == row for row in sample.rows()]))
+        self.assertEqual(sample, table.sample(10, seed=1))
+        self.assertEqual(table.sample(0).height(), 0)
+        self.assertEqual(sorted(table.sample(100).rows()), rows)
+        self.assertEqual(table.sample(150, seed=2, replace=True).height(), 150)
+
+        with self.assertRaises(ValueError):
+            table.sample(101)
+
+        with self.assertRaises(ValueError):
+            Table(["i"], []).sample(1, replace=True)
+
+        for sampled in [table, table.categorize(["g"])]:
+            sample = sampled.stratified_sample("g", 5, seed=3)
+            self.assertEqual(Counter(sample.column("g")), {0: 5, 1: 5, 2: 5})
+            self.assertEqual(sample.column("i"), sorted(sample.column("i")))
+            self.assertTrue(all([rows[row[0]] == row for row in sample.rows()]))
+
+        self.assertEqual(table.stratified_sample("g", 50).height(), 100)
+        self.assertEqual(table.stratified_sample("g", 5, seed=4), table.stratified_sample("g", 5, seed=4))
+
     def test_table_shuffle(self):
         table = Table.load_csv("col1,col2\n1,2\n3,4\n5,6\n7,8\n9,10\n11,12")
         table_shuffle = table.shuffle()
@@ -237,6 +730,58 @@ class Tests(TestCase):
         for row in table.rows():
             self.assertTrue(row in table_shuffle.rows())
 
+    def test_table_lazy(self):
+        table = Table.load_csv("col1,col2,col3\n1,2,3\n4,5,6\n4,5,7\n8,2,9")
+        pipelines = [
+            lambda t: t.refine("col2", "5").convert("col1", int).extend(["col1", "col3"], lambda a, b: a + int(b), "col4"),
+            lambda t: t.convert("col3", int).refine("col3", lambda v: v > 3).narrow(["col3", "col1"]).sort("col3", reverse=True),
+            lambda t: t.extend(["col1"], int, "col4").sort("col4").narrow(["col2", "col1"], unique=True),
+            lambda t: t.drop(["col3"], unique=True).refine(refinements={"col1": "4", "col2": "5"}),
+            lambda t: t.extend(extensions=[{"names": [], "func": lambda: 1, "target": "one"}]).narrow(["one"]),
+            lambda t: t.convert("col1", int).extend(["col1", "col3"], lambda a, b: a + int(b), "col4") \
+                .refine("col4", lambda v: v > 7).narrow(["col4", "col2"]),
+            lambda t: t.convert("col1", int).refine(refinements={"col1": lambda v: v > 1, "col2": "5"}).refine("col3", "7"),
+            lambda t: t.narrow([]),
+            lambda t: t,
+        ]
+
+        for pipeline in pipelines:
+            expected = pipeline(table)
+            lazy = pipeline(table.lazy())
+            self.assertEqual(lazy.header(), expected.header())
+            self.assertEqual(lazy.collect(), expected)
+            self.assertEqual(lazy.rows(), expected.rows())
+
+        self.assertEqual(table.lazy().rows(["col2"], unique=True), table.rows(["col2"], unique=True))
+
+        # Refines on columns which aren't changed beforehand run first.
+        calls = []
+        lazy = table.lazy().convert("col3", lambda v: calls.append(v) or int(v)).refine("col2", "5")
+        self.assertEqual(lazy.collect(), table.refine("col2", "5").convert("col3", int))
+        self.assertEqual(calls, ["6", "7"])
+
+        # The steps leading up to a refine which depends on them run over chunks of the rows.
+        big = Table(["i", "s"], [[i, str(i % 7)] for i in range(0, CHUNK_ROWS + 10)])
+        pipeline = lambda t: t.convert("i", lambda v: v * 2).refine("i", lambda v: v % 3 == 0).convert("s", int) \
+            .extend(["i", "s"], lambda i, s: i + s, "sum")
+        self.assertEqual(pipeline(big.lazy()).collect(), pipeline(big))
+
+        # Unused conversions and extensions are never evaluated.
+        calls = []
+        lazy = table.lazy() \
+            .convert("col3", lambda v: calls.append(v)) \
+            .extend(["col1"], lambda v: calls.append(v), "col4") \
+            .narrow(["col1", "col2"])
+        self.assertEqual(calls, [])
+        self.assertEqual(lazy.collect(), table.narrow(["col1", "col2"]))
+        self.assertEqual(calls, [])
+
+        with self.assertRaises(ValueError):
+            table.lazy().narrow(["col1"]).refine("col2", "5")
+
+        with self.assertRaises(ValueError):
+            table.lazy().extend(["col1"], int, "col2")
+
     def test_table_column(self):
         table = Table.load_csv("col1,col2,col3\n1,2,3\n4,5,6")
         self.assertEqual(table.column("col1"), ["1", "4"])
@@ -272,6 +817,103 @@ class Tests(TestCase):
         self.assertEqual(table.header(),
                          ["col1_0", "col2", "col1_1", "col1_2"])
 
+    def test_table_save_open(self):
+        table = Table(["i", "f", "s", "m", "e"], [
+            [1, 1.5, "a", None, ""],
+            [2, 2.5, "b\u00e9", 1, ""],
+            [3, 3.5, "", "x", ""],
+        ])
+
+        with TemporaryDirectory() as directory:
+            for source in [table, table.top(2).merge(table.bottom(2)), table.top(0)]:
+                source.save(directory)
+
+                for mmap in [True, False]:
+                    opened = Table.open(directory, mmap)
+                    self.assertEqual(opened, source)
+                    self.assertEqual(opened.rows(), source.rows())
+                    self.assertEqual(opened.refine("i", lambda v: v > 1).sort("s", reverse=True),
+                        source.refine("i", lambda v: v > 1).sort("s", reverse=True))
+                    self.assertEqual(opened.bottom(1).merge(opened.top(1)).materialize(),
+                        source.bottom(1).merge(source.top(1)))
+                    self.assertEqual(opened.group_by(["s"]).aggregate({"f": ("f", SUM)}),
+                        source.group_by(["s"]).aggregate({"f": ("f", SUM)}))
+                    # Opened tables (and views over them) can still be pickled.
+                    self.assertEqual(pickle.loads(pickle.dumps(opened)), source)
+                    self.assertEqual(pickle.loads(pickle.dumps(opened.categorize(["s"]).top(2))), source.top(2))
+
+            table.categorize(["s"]).save(directory)
+            self.assertEqual(pickle.loads(pickle.dumps(Table.open(directory))), table)
+
+    def test_table_unpickle_legacy(self):
+        # The state of a table pickled by earlier versions (ie: as unpickling restores it).
+        table = Table.__new__(Table)
+        table.__setstate__({
+            "_header": ["i", "s"],
+            "_rows": [[1, "a"], [2, "b"], [3, "a"]],
+            "_columns": [[1, 2, 3], ["a", "b", "a"]],
+        })
+        self.assertEqual(table, Table(["i", "s"], [[1, "a"], [2, "b"], [3, "a"]]))
+        self.assertEqual(table.refine("s", "a").column("i"), [1, 3])
+        self.assertEqual(table.describe(["i"]).column("max"), [3])
+        self.assertFalse(hasattr(table, "_rows"))
+
+    def test_table_iter_csv(self):
+        csv = "col1,col2,col1\n1,2,3\n4,5,6\n7,8,9\n"
+        chunks = [chunk for chunk in Table.iter_csv(csv.splitlines(True), 2, {"col2": int}, INDEXING)]
+        self.assertEqual([chunk.header() for chunk in chunks], [["col1_0", "col2", "col1_1"]] * 2)
+        self.assertEqual([chunk.rows() for chunk in chunks], [[["1", 2, "3"], ["4", 5, "6"]], [["7", 8, "9"]]])
+
+        with TemporaryDirectory() as directory:
+            for name, opener in [("plain.csv", open), ("compressed.csv.gz", gzip.open), ("compressed.csv.bz2", bz2.open)]:
+                path = os.path.join(directory, name)
+
+                with opener(path, "wt") as fh:
+                    fh.write(csv)
+
+                chunks = [chunk for chunk in Table.iter_csv(path, chunk_rows=1, rename_strategy=INDEXING)]
+                self.assertEqual(len(chunks), 3)
+                self.assertEqual(chunks[0].merge(chunks[1]).merge(chunks[2]),
+                    Table.load_csv(csv.strip(), rename_strategy=INDEXING))
+
+        self.assertEqual([chunk for chunk in Table.iter_csv(["col1,col2"])], [])
+
+        # The same options as load_csv.
+        chunks = [chunk for chunk in Table.iter_csv(csv.splitlines(True), 2, {"col2": str}, INDEXING, infer_types=True)]
+        self.assertEqual([chunk.rows() for chunk in chunks], [[[1, "2", 3], [4, "5", 6]], [[7, "8", 9]]])
+        self.assertEqual(chunks[0].merge(chunks[1]),
+            Table.load_csv(csv.strip(), {"col2": str}, INDEXING, infer_types=True))
+        self.assertEqual(chunks[0]._columns[0].typecode, "q")
+
+        with self.assertRaises(ValueError):
+            next(Table.iter_csv(csv.splitlines(True), 0))
+
+    def test_table_load_csv_infer_types(self):
+        table = Table.load_csv("i,f,b,d,s,n,e,late\n" \
+            "1,1.5,yes,2020-01-31,a,,,1\n" \
+            "2,2,False,2021-12-01,1,3,,2\n" \
+            "-3,1e3,t,1999-01-01,x,4,,3.5", infer_types=True)
+        self.assertEqual(table.rows(), [
+            [1, 1.5, True, date(2020, 1, 31), "a", None, "", 1.0],
+            [2, 2.0, False, date(2021, 12, 1), "1", 3, "", 2.0],
+            [-3, 1000.0, True, date(1999, 1, 1), "x", 4, "", 3.5]
+        ])
+        self.assertEqual([type(value) for value in table.rows()[0]], [int, float, bool, date, str, type(None), str, float])
+
+        # Values the sample misses still fall back to a fitting type.
+        lines = ["f,s"] + ["%d,%d" % (i, i) for i in range(0, 3000)]
+        lines[2] = "0.5,1"
+        lines[3] = "2,x"
+        table = Table.load_csv(lines, infer_types=True)
+        self.assertEqual(table.column("f", 3), [0.0, 0.5, 2.0])
+        self.assertEqual(table.column("s", 3), ["0", "1", "x"])
+
+        table = Table.load_csv("i,s\n1,2\n3,4", {"s": lambda v: v * 2}, infer_types=True)
+        self.assertEqual(table.rows(), [[1, 4], [3, 8]])
+
+        with self.assertRaises(ValueError):
+            Table.load_csv("i,s\n1,2\n3", infer_types=True)
+
     def test_table_equality(self):
         table_a = Table.load_csv("col1,col2,col3\n1,2,3\n4,5,6")
         table_b = Table.load_csv("col1,col2,col3\n1,2,3\n4,5,6")